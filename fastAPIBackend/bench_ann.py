@@ -0,0 +1,100 @@
+# bench_ann.py
+# Query latency of the in-process ANN index at n vectors: the old layout
+# (float16 lists, retrained at 4x growth, every query concatenating and
+# casting the probed lists) against the current one (float32 lists,
+# retrained at IVF_RETRAIN_GROWTH, one matrix-vector product per list).
+#
+#   python bench_ann.py [n_vectors] [n_queries]     # default 1,000,000 / 500
+#
+# No database needed. Vectors are random unit vectors around a few thousand
+# topics, so the lists fill roughly as they would with real comments.
+import math
+import sys
+import time
+
+import numpy as np
+
+from utils import ann_index as ann
+from utils.embeddings import EMBEDDING_DIM
+
+CHUNK = 100_000
+
+
+def synthetic_vectors(start, n, topics, seed=3):
+    rng = np.random.default_rng(seed + start)
+    v = topics[rng.integers(len(topics), size=n)] + rng.normal(scale=0.08, size=(n, EMBEDDING_DIM)).astype(np.float32)
+    return v / np.linalg.norm(v, axis=1, keepdims=True)
+
+
+def build(n, growth, topics):
+    """An index in the state it reaches at n vectors when retrained at `growth`x."""
+    index = ann.EmbeddingIndex()
+    trained = max(ann.IVF_MIN_TRAIN, math.ceil(n / growth))
+    chunks = [
+        ann._VectorList.from_arrays(list(range(s, s + min(CHUNK, trained - s))),
+                                    synthetic_vectors(s, min(CHUNK, trained - s), topics),
+                                    np.zeros(min(CHUNK, trained - s), dtype=np.int32))
+        for s in range(0, trained, CHUNK)
+    ]
+    centroids, lists, size = index._train([(c, len(c)) for c in chunks])
+    del chunks
+    index.layout, index.trained_size, index.size = (centroids, lists), size, size
+    index.group_code(None, None)
+    for s in range(trained, n, CHUNK):
+        for i, v in enumerate(synthetic_vectors(s, min(CHUNK, n - s), topics), start=s):
+            index.add(i, v)
+    return index
+
+
+def legacy_search(index, vector, k=10):
+    # the search as it was: concatenate the probed float16 lists, cast, score
+    centroids, lists = index.layout
+    closest = np.argpartition(-(centroids @ vector), ann.IVF_NPROBE - 1)[:ann.IVF_NPROBE]
+    probed = [lists[i] for i in closest if len(lists[i])]
+    vectors = np.concatenate([lst.vectors[:len(lst)] for lst in probed]).astype(np.float32)
+    sims = vectors @ vector
+    ids = [rid for lst in probed for rid in lst.ids]
+    top = np.argpartition(-sims, k - 1)[:k]
+    return [(ids[i], float(sims[i])) for i in top[np.argsort(-sims[top])]]
+
+
+def time_queries(search, queries):
+    times = []
+    for q in queries:
+        start = time.perf_counter()
+        search(q)
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000
+    return np.percentile(times, 50), np.percentile(times, 99)
+
+
+def describe(index):
+    sizes = [len(lst) for lst in index.layout[1]]
+    return f"{len(sizes)} lists, mean {np.mean(sizes):.0f} / max {max(sizes)} vectors"
+
+
+def main(n, n_queries):
+    rng = np.random.default_rng(1)
+    topics = rng.normal(size=(4096, EMBEDDING_DIM)).astype(np.float32)
+    topics /= np.linalg.norm(topics, axis=1, keepdims=True)
+    queries = synthetic_vectors(10 ** 9, n_queries, topics)
+
+    index = build(n, 4, topics)
+    for lst in index.layout[1]:
+        lst.vectors = lst.vectors[:len(lst)].astype(np.float16)
+    layout = describe(index)
+    legacy = time_queries(lambda q: legacy_search(index, q), queries)
+    del index
+
+    start = time.perf_counter()
+    index = build(n, ann.IVF_RETRAIN_GROWTH, topics)
+    built = time.perf_counter() - start
+    current = time_queries(lambda q: index.search(q, k=10), queries)
+
+    print(f"🧭 {n} vectors, {n_queries} queries, nprobe {ann.IVF_NPROBE}")
+    print(f"   legacy:  p50 {legacy[0]:.2f} ms  p99 {legacy[1]:.2f} ms  ({layout})")
+    print(f"   current: p50 {current[0]:.2f} ms  p99 {current[1]:.2f} ms  ({describe(index)}, built in {built:.0f}s)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000, int(sys.argv[2]) if len(sys.argv) > 2 else 500)
@@ -0,0 +1,119 @@
+# bench_heatmap.py
+# Times the heatmap aggregation (location parsing, per-(tag, district)
+# grouping and marker iteration) of the old row-by-row code against the
+# columnar aggregate_heatmap_points, on synthetic reports - once parsing the
+# device_location strings, once with lat / lon projected from the GeoJSON location.
+#
+#   python bench_heatmap.py [n_points]       # default 1,000,000
+#
+# No database needed; folium rendering is left out as it is the same for both.
+import random
+import sys
+import time
+
+import pandas as pd
+
+from heatmap_services import aggregate_heatmap_points, TAG_COLOR
+
+DISTRICTS = ["North", "South", "East", "West", "Central", "New Delhi", "Shahdara", "Dwarka"]
+
+
+def synthetic_docs(n, seed=7, geojson=False):
+    rng = random.Random(seed)
+    tags = list(TAG_COLOR)
+    docs = []
+    for i in range(n):
+        if i % 100 == 0:
+            location = "not a location"  # the odd bad string, as found in real data
+        else:
+            location = f"{28.4 + rng.random() * 0.5:.6f}, {76.8 + rng.random() * 0.6:.6f}"
+        doc = {
+            "device_location": location,
+            "public_service": rng.choice(tags),
+            "district": rng.choice(DISTRICTS),
+            "rating": rng.randint(1, 5),
+        }
+        if geojson and "," in location:
+            # reports with a GeoJSON location are projected as numeric lat / lon
+            doc["lat"], doc["lon"] = (float(v) for v in doc.pop("device_location").split(","))
+        docs.append(doc)
+    return docs
+
+
+def legacy_aggregate(docs):
+    """The per-row implementation generate_heatmap_html used before."""
+    parsed_rows = []
+    for d in docs:
+        loc = d.get("device_location")
+        if not loc:
+            continue
+        try:
+            lat_str, lon_str = loc.split(",")
+            lat, lon = float(lat_str.strip()), float(lon_str.strip())
+        except Exception:
+            continue
+        parsed_rows.append({
+            "tag": d.get("public_service"),
+            "district": d.get("district"),
+            "rating": d.get("rating", 0),
+            "lat": lat,
+            "lon": lon
+        })
+
+    df = pd.DataFrame(parsed_rows)
+    agg_df = (
+        df.groupby(["tag", "district"])
+        .agg(
+            count=("rating", "count"),
+            avg_sentiment=("rating", lambda x: round(
+                x.apply(lambda r: 1 if r > 3 else (0 if r == 3 else -1)).mean(), 3)
+            ),
+            sample_lat=("lat", "first"),
+            sample_lon=("lon", "first")
+        )
+        .reset_index()
+    )
+    heat_points = [[r["lat"], r["lon"], 1] for r in parsed_rows]
+    markers = [(row["tag"], row["count"], row["avg_sentiment"]) for _, row in agg_df.iterrows()]
+    return heat_points, agg_df, markers
+
+
+def columnar_aggregate(docs):
+    heat_points, agg_df = aggregate_heatmap_points(docs)
+    columns = ["tag", "count", "avg_sentiment"]
+    markers = list(zip(*(agg_df[c].tolist() for c in columns)))
+    return heat_points, agg_df, markers
+
+
+def timed(fn, docs):
+    start = time.perf_counter()
+    result = fn(docs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    print(f"🧪 Generating {n:,} synthetic reports")
+    docs = synthetic_docs(n)
+
+    (old_points, old_agg, old_markers), old_s = timed(legacy_aggregate, docs)
+    (new_points, new_agg, new_markers), new_s = timed(columnar_aggregate, docs)
+    geo_docs = synthetic_docs(n, geojson=True)
+    (geo_points, _, geo_markers), geo_s = timed(columnar_aggregate, geo_docs)
+
+    assert len(old_points) == len(new_points) == len(geo_points), "point counts differ"
+    assert [m[:2] for m in geo_markers] == [m[:2] for m in new_markers], "GeoJSON marker rows differ"
+    assert [m[:2] for m in old_markers] == [m[:2] for m in new_markers], "marker rows differ"
+    assert all(abs(a[2] - b[2]) <= 1e-3 for a, b in zip(old_markers, new_markers)), "sentiments differ"
+    pd.testing.assert_frame_equal(
+        old_agg[["sample_lat", "sample_lon"]], new_agg[["sample_lat", "sample_lon"]], check_dtype=False,
+    )
+
+    print(f"  row-by-row : {old_s:8.2f}s")
+    print(f"  columnar   : {new_s:8.2f}s  ({old_s / new_s:.1f}x)  from device_location strings")
+    print(f"  columnar   : {geo_s:8.2f}s  ({old_s / geo_s:.1f}x)  from projected GeoJSON lat / lon")
+    print(f"⚡ on {len(new_points):,} valid points, {len(new_markers)} markers")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+# bench_roundtrips.py
+# Counts MongoDB round-trips per processed report, old pipeline vs new.
+#
+#   python bench_roundtrips.py [n_reports]
+#
+# Runs against a scratch database (dropped afterwards) on MONGO_URI.
+import asyncio
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+
+import motor.motor_asyncio
+from bson import ObjectId
+from pymongo import monitoring
+from pymongo.server_api import ServerApi
+
+import database
+from pipeline.inference_queue import batcher
+from pipeline.job_queue import JobWorker, enqueue_jobs
+from pipeline.process_report import process_report, record_stats, report_writer
+from utils.stats_aggregator import stats_aggregator
+
+BENCH_DB = "nsut_bench_roundtrips"
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.counts = Counter()
+
+    def started(self, event):
+        self.counts[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def total(self):
+        return sum(self.counts.values())
+
+
+def sample_report(i):
+    return {
+        "city": "Pune",
+        "timestamp": datetime.utcnow(),
+        "rating": 1 + i % 5,
+        "comment": f"Street light number {i} has been broken for a week, the road is unsafe at night",
+        "public_service": "Street Lights",
+        "district": "Pune",
+        "processing": 0,
+    }
+
+
+async def legacy_process(db, report_id, model_out):
+    # The DB calls the pipeline used to make for every report
+    report = await db.reports.find_one({"_id": ObjectId(report_id)})
+    await db.reports.update_one({"_id": ObjectId(report_id)}, {"$set": {"cleaned_comment": "x", "processing": 1}})
+    await db.reports.update_one({"_id": ObjectId(report_id)}, {"$set": {"_model_output": model_out, "processing": 2}})
+    for doc_id, scope, district in (("global_stats", "global", None),
+                                    (f"district_{report['district']}", "district", report["district"])):
+        await legacy_stats_update(db, doc_id, scope, district, model_out, report["public_service"], report["rating"])
+
+
+async def legacy_stats_update(db, doc_id, scope, district, model_output, service, rating):
+    # The old read-modify-write stats updater: one find_one + one update_one per stats document
+    stats = await db.stats.find_one({"_id": doc_id}) or {}
+    total = stats.get("total_feedback_overall", 0)
+    s = model_output.get("sentiment", "neutral")
+    s_counts = stats.get("sentiment_counts_overall", {"positive": 0, "neutral": 0, "negative": 0})
+    s_counts[s] = s_counts.get(s, 0) + 1
+    by_service = stats.get("total_feedback_by_service", {})
+    by_service[service] = by_service.get(service, 0) + 1
+    timeline = stats.get("feedback_over_time", {})
+    today = datetime.utcnow().strftime("%Y-%m-%d")
+    timeline[today] = timeline.get(today, 0) + 1
+    await db.stats.update_one(
+        {"_id": doc_id},
+        {"$set": {
+            "scope": scope,
+            "district": district,
+            "avg_rating_overall": round((stats.get("avg_rating_overall", 0) * total + rating) / (total + 1), 2),
+            "sentiment_counts_overall": s_counts,
+            "total_feedback_overall": total + 1,
+            "total_feedback_by_service": by_service,
+            "feedback_over_time": timeline,
+            "last_updated": datetime.utcnow(),
+        }},
+        upsert=True,
+    )
+
+
+async def main(n):
+    counter = CommandCounter()
+    database.client = motor.motor_asyncio.AsyncIOMotorClient(
+        database.MONGO_URI, server_api=ServerApi("1"), event_listeners=[counter]
+    )
+    database.db = database.client[BENCH_DB]
+    db = database.db
+    await db.client.drop_database(BENCH_DB)
+
+    model_out = {"sentiment": "negative", "sentiment_confidence": 0.9}
+
+    # --- legacy pipeline (DB calls only) ---
+    result = await db.reports.insert_many([sample_report(i) for i in range(n)])
+    counter.counts.clear()
+    for rid in result.inserted_ids:
+        await legacy_process(db, str(rid), model_out)
+    legacy = counter.total()
+    legacy_by_cmd = dict(counter.counts)
+
+    # --- new pipeline (job queue + batched writes) ---
+    await db.client.drop_database(BENCH_DB)
+    reports = [sample_report(i) for i in range(n)]
+    await db.reports.insert_many(reports)
+    await enqueue_jobs(db, reports)
+    counter.counts.clear()
+
+    batcher.start()
+    stats_aggregator.start()
+    worker = JobWorker(process_report, on_complete=record_stats)
+    start = time.perf_counter()
+    worker.start()
+    # poll through a separate, unmonitored client so it doesn't count
+    poll_client = motor.motor_asyncio.AsyncIOMotorClient(database.MONGO_URI, server_api=ServerApi("1"))
+    while await poll_client[BENCH_DB].jobs.count_documents({"state": {"$ne": "done"}}) > 0:
+        await asyncio.sleep(0.5)
+    poll_client.close()
+    elapsed = time.perf_counter() - start
+    await worker.stop()
+    await batcher.stop()
+    await report_writer.flush()
+    await stats_aggregator.stop()
+    new = counter.total()
+
+    print(f"📊 {n} reports")
+    print(f"   legacy: {legacy / n:.2f} round-trips/report {legacy_by_cmd}")
+    print(f"   new:    {new / n:.2f} round-trips/report {dict(counter.counts)} ({elapsed:.1f}s incl. inference)")
+
+    await db.client.drop_database(BENCH_DB)
+    database.client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200))
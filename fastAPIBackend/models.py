@@ -49,7 +49,9 @@ class Stats(BaseModel):
     scope: str = Field(default="global")  # 'global' or 'district'
     district: Optional[str] = None
 
-    # Average ratings
+    # Rating sums (stored, updated with $inc) and averages (derived on read)
+    rating_sum_overall: float = 0.0
+    rating_sum_by_service: Dict[str, float] = {}
     avg_rating_overall: float = 0.0
     avg_rating_by_service: Dict[str, float] = {}
 
@@ -62,4 +64,8 @@ class Stats(BaseModel):
     total_feedback_by_service: Dict[str, int] = {}
 
     feedback_over_time: Dict[str, int] = {}
+
+    # Derived from the mergeable sketches of the district documents
+    percentiles: Dict[str, Dict[str, Optional[float]]] = {}
+    distinct_counts: Dict[str, int] = {}
     last_updated: datetime = Field(default_factory=datetime.utcnow)
\ No newline at end of file
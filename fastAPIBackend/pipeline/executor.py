@@ -0,0 +1,75 @@
+# pipeline/executor.py
+import asyncio, os, time
+from concurrent.futures import ThreadPoolExecutor
+
+# Worker counts and queue bounds for the CPU-heavy pipeline stages.
+NLP_WORKERS = int(os.getenv("NLP_WORKERS", "2"))
+NLP_QUEUE_SIZE = int(os.getenv("NLP_QUEUE_SIZE", "256"))
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "256"))
+HEATMAP_WORKERS = int(os.getenv("HEATMAP_WORKERS", "1"))
+HEATMAP_QUEUE_SIZE = int(os.getenv("HEATMAP_QUEUE_SIZE", "8"))
+ANN_WORKERS = int(os.getenv("ANN_WORKERS", "2"))
+ANN_QUEUE_SIZE = int(os.getenv("ANN_QUEUE_SIZE", "256"))
+
+
+class BoundedExecutor:
+    """
+    Thread pool that the async pipeline awaits instead of running blocking
+    work on the event loop. At most `workers + queue_size` calls may be
+    pending; further callers wait, which pushes back on the producers.
+    """
+
+    def __init__(self, name, workers, queue_size):
+        self.name = name
+        self.workers = max(1, workers)
+        self.queue_size = max(0, queue_size)
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=name)
+        self._slots = asyncio.Semaphore(self.workers + self.queue_size)
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+
+    async def run(self, fn, *args):
+        self.pending += 1
+        try:
+            async with self._slots:
+                return await asyncio.get_running_loop().run_in_executor(self._pool, self._timed, fn, args)
+        finally:
+            self.pending -= 1
+
+    def _timed(self, fn, args):
+        self.running += 1
+        start = time.perf_counter()
+        try:
+            result = fn(*args)
+            self.completed += 1
+            return result
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.busy_seconds += time.perf_counter() - start
+            self.running -= 1
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "queue_depth": max(0, self.pending - self.running),
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "busy_seconds": round(self.busy_seconds, 3),
+        }
+
+
+nlp_executor = BoundedExecutor("nlp", NLP_WORKERS, NLP_QUEUE_SIZE)
+inference_executor = BoundedExecutor("inference", INFERENCE_WORKERS, INFERENCE_QUEUE_SIZE)
+heatmap_executor = BoundedExecutor("heatmap", HEATMAP_WORKERS, HEATMAP_QUEUE_SIZE)
+ann_executor = BoundedExecutor("ann", ANN_WORKERS, ANN_QUEUE_SIZE)
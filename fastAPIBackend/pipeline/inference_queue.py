@@ -0,0 +1,128 @@
+# pipeline/inference_queue.py
+import asyncio, os
+from collections import Counter
+from pipeline.model_output import model_outputs_from_texts
+from pipeline.executor import inference_executor, INFERENCE_QUEUE_SIZE
+
+# A batch is dispatched as soon as MAX_BATCH_SIZE reports are waiting, or
+# MAX_WAIT_MS after the first report of the batch arrived, whichever is first.
+MAX_BATCH_SIZE = int(os.getenv("INFERENCE_MAX_BATCH_SIZE", "16"))
+MAX_WAIT_MS = float(os.getenv("INFERENCE_MAX_WAIT_MS", "10"))
+
+
+class InferenceBatcher:
+    """
+    Central inference queue shared by all process_report tasks.
+    Callers await submit() and get back the same dict model_output_from_text
+    would return, but the models run on real tensor batches inside the
+    inference executor, off the event loop. The queue is bounded, so submit()
+    waits when inference falls behind.
+    """
+
+    def __init__(self, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS,
+                 executor=inference_executor, queue_size=INFERENCE_QUEUE_SIZE):
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.batch_sizes = Counter()
+        self.total_items = 0
+        self.isolation_retries = 0
+        self._task = None
+        self._dispatches = set()
+        # one in-flight batch per executor worker; while all are busy the
+        # queue keeps filling, so the next batch comes out larger
+        self._inflight = asyncio.Semaphore(executor.workers)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def submit(self, text, rating=3):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, rating, future))
+        return await future
+
+    async def _collect_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            await self._inflight.acquire()
+            try:
+                batch = await self._collect_batch()
+            except asyncio.CancelledError:
+                self._inflight.release()
+                raise
+            task = asyncio.create_task(self._dispatch(batch))
+            self._dispatches.add(task)
+            task.add_done_callback(self._dispatches.discard)
+
+    async def _dispatch(self, batch):
+        try:
+            await self._infer(batch)
+        finally:
+            self._inflight.release()
+
+    async def _infer(self, batch):
+        texts = [item[0] for item in batch]
+        ratings = [item[1] for item in batch]
+        try:
+            outputs = await self.executor.run(model_outputs_from_texts, texts, ratings)
+        except Exception as e:
+            print(f"❌ Inference batch of {len(batch)} failed:", e)
+            if len(batch) > 1:
+                # one bad input must not fail (and, retried together, dead-letter)
+                # the healthy reports batched with it: rerun each on its own
+                self.isolation_retries += 1
+                for item in batch:
+                    await self._infer([item])
+                return
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batch_sizes[len(batch)] += 1
+        self.total_items += len(batch)
+        print(f"🧠 Inference batch of {len(batch)} done")
+        for (_, _, future), out in zip(batch, outputs):
+            if not future.done():
+                future.set_result(out)
+
+    def stats(self):
+        total_batches = sum(self.batch_sizes.values())
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "queue_depth": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "total_batches": total_batches,
+            "total_items": self.total_items,
+            "isolation_retries": self.isolation_retries,
+            "avg_batch_size": round(self.total_items / total_batches, 2) if total_batches else 0.0,
+            "batch_size_histogram": {str(k): v for k, v in sorted(self.batch_sizes.items())},
+        }
+
+
+batcher = InferenceBatcher()
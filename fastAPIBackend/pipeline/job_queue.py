@@ -0,0 +1,336 @@
+# pipeline/job_queue.py
+import asyncio, os, socket, uuid
+from datetime import datetime, timedelta
+from pymongo import UpdateOne, ASCENDING
+import database
+from utils.bulk_writer import BulkWriter
+
+# One job per report, stored in the `jobs` collection with the report's _id.
+# States: queued -> running -> done, or back to queued (with backoff) on
+# failure / lease expiry, and finally dead once MAX_ATTEMPTS is used up.
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "32"))
+JOB_CLAIM_BATCH = int(os.getenv("JOB_CLAIM_BATCH", "16"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_HEARTBEAT_SECONDS = int(os.getenv("JOB_HEARTBEAT_SECONDS", "30"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_BACKOFF_BASE_SECONDS = int(os.getenv("JOB_BACKOFF_BASE_SECONDS", "10"))
+JOB_BACKOFF_MAX_SECONDS = int(os.getenv("JOB_BACKOFF_MAX_SECONDS", "3600"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+JOB_SWEEP_SECONDS = int(os.getenv("JOB_SWEEP_SECONDS", "60"))
+# Done jobs whose stats are applied are deleted this long after finishing;
+# dead jobs are kept for inspection.
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", str(7 * 24 * 3600)))
+
+# Report fields copied into the job, so the worker never has to re-read the
+# report it was handed by the API.
+JOB_PAYLOAD_FIELDS = ["comment", "rating", "public_service", "district", "city", "gender", "age",
+                      "name", "device_location"]
+
+
+def backoff_seconds(attempts):
+    return min(JOB_BACKOFF_MAX_SECONDS, JOB_BACKOFF_BASE_SECONDS * 2 ** max(0, attempts - 1))
+
+
+async def ensure_job_indexes(db):
+    await db.jobs.create_index([("state", ASCENDING), ("run_after", ASCENDING)])
+    await db.jobs.create_index([("state", ASCENDING), ("lease_until", ASCENDING)])
+    await db.jobs.create_index(
+        "finished_at",
+        expireAfterSeconds=JOB_RETENTION_SECONDS,
+        partialFilterExpression={"state": "done", "stats_applied": True},
+    )
+    # jobs completed before the payload was dropped on completion
+    await db.jobs.update_many({"state": "done", "report": {"$exists": True}}, {"$unset": {"report": ""}})
+
+
+def job_payload(report):
+    return {f: report.get(f) for f in JOB_PAYLOAD_FIELDS}
+
+
+async def enqueue_jobs(db, reports):
+    """
+    Idempotently creates a queued job for every report document (which must
+    carry its _id). Existing jobs are left untouched, so re-enqueueing a
+    report never resets its attempts.
+    """
+    if not reports:
+        return
+    now = datetime.utcnow()
+    ops = [
+        UpdateOne(
+            {"_id": report["_id"]},
+            {"$setOnInsert": {
+                "state": "queued",
+                "attempts": 0,
+                "run_after": now,
+                "created_at": now,
+                "report": job_payload(report),
+            }},
+            upsert=True,
+        )
+        for report in reports
+    ]
+    await db.jobs.bulk_write(ops, ordered=False)
+
+
+async def claim_jobs(db, worker_id, limit):
+    """
+    Leases up to `limit` runnable jobs in three round-trips regardless of
+    `limit`: pick candidates, flip them to running under a claim token (the
+    state filter makes this atomic per job, so concurrent workers never get
+    the same job), then read back the ones this worker actually won.
+    """
+    now = datetime.utcnow()
+    cursor = db.jobs.find({"state": "queued", "run_after": {"$lte": now}}, {"_id": 1})
+    ids = [job["_id"] for job in await cursor.sort("run_after", ASCENDING).limit(limit).to_list(length=limit)]
+    if not ids:
+        return []
+
+    token = uuid.uuid4().hex
+    await db.jobs.update_many(
+        {"_id": {"$in": ids}, "state": "queued"},
+        {
+            "$set": {
+                "state": "running",
+                "worker": worker_id,
+                "claim": token,
+                "lease_until": now + timedelta(seconds=JOB_LEASE_SECONDS),
+                "started_at": now,
+            },
+            "$inc": {"attempts": 1},
+        },
+    )
+    return await db.jobs.find({"_id": {"$in": ids}, "claim": token}).to_list(length=limit)
+
+
+async def heartbeat_jobs(db, worker_id, job_ids):
+    if not job_ids:
+        return
+    await db.jobs.update_many(
+        {"_id": {"$in": list(job_ids)}, "worker": worker_id, "state": "running"},
+        {"$set": {"lease_until": datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS)}},
+    )
+
+
+def complete_job_op(job, result=None):
+    """
+    Completes `job` only under the claim that leased it: once its lease
+    expired and the job was requeued or claimed again, the update matches
+    nothing and the result is dropped. The report payload is dropped with
+    the lease: the report document itself has it.
+    """
+    done = {"state": "done", "finished_at": datetime.utcnow()}
+    if result is not None:
+        done["result"] = result
+    return UpdateOne(
+        {"_id": job["_id"], "claim": job["claim"], "state": "running"},
+        {"$set": done, "$unset": {"lease_until": "", "report": ""}},
+    )
+
+
+async def completed_under_claim(db, job):
+    return await db.jobs.count_documents({"_id": job["_id"], "claim": job["claim"], "state": "done"}, limit=1) > 0
+
+
+async def fail_job(db, job, error):
+    """Schedules a retry with exponential backoff, or dead-letters the job."""
+    now = datetime.utcnow()
+    if job["attempts"] >= JOB_MAX_ATTEMPTS:
+        await _dead_letter(db, job["_id"], error)
+        return
+    await db.jobs.update_one(
+        {"_id": job["_id"], "claim": job.get("claim"), "state": "running"},
+        {
+            "$set": {
+                "state": "queued",
+                "run_after": now + timedelta(seconds=backoff_seconds(job["attempts"])),
+                "last_error": error,
+            },
+            "$unset": {"lease_until": "", "worker": ""},
+        },
+    )
+
+
+async def _dead_letter(db, job_id, error):
+    await db.jobs.update_one(
+        {"_id": job_id},
+        {"$set": {"state": "dead", "last_error": error, "finished_at": datetime.utcnow()},
+         "$unset": {"lease_until": ""}},
+    )
+    await db.reports.update_one({"_id": job_id}, {"$set": {"processing": -1}})
+    print(f"💀 Report {job_id} moved to dead-letter: {error}")
+
+
+async def release_jobs(db, worker_id, job_ids):
+    """Hands unfinished jobs back on graceful shutdown without using up an attempt."""
+    if not job_ids:
+        return
+    await db.jobs.update_many(
+        {"_id": {"$in": list(job_ids)}, "worker": worker_id, "state": "running"},
+        {"$set": {"state": "queued", "run_after": datetime.utcnow()},
+         "$inc": {"attempts": -1},
+         "$unset": {"lease_until": "", "worker": ""}},
+    )
+
+
+async def sweep_expired_leases(db):
+    """
+    Jobs whose worker died keep state=running with a lease in the past.
+    They go back to the queue with backoff, or to dead-letter when their
+    attempts are used up (a report that keeps crashing its worker).
+    """
+    now = datetime.utcnow()
+    requeued = dead = 0
+    cursor = db.jobs.find({"state": "running", "lease_until": {"$lt": now}}, {"attempts": 1})
+    async for job in cursor:
+        if job.get("attempts", 0) >= JOB_MAX_ATTEMPTS:
+            await _dead_letter(db, job["_id"], "lease expired")
+            dead += 1
+            continue
+        result = await db.jobs.update_one(
+            {"_id": job["_id"], "state": "running", "lease_until": {"$lt": now}},
+            {"$set": {
+                "state": "queued",
+                "run_after": now + timedelta(seconds=backoff_seconds(job.get("attempts", 1))),
+                "last_error": "lease expired",
+            }, "$unset": {"lease_until": "", "worker": ""}},
+        )
+        requeued += result.modified_count
+    if requeued or dead:
+        print(f"🧹 Requeued {requeued} expired jobs, dead-lettered {dead}")
+
+
+async def recover_stuck_reports(db, chunk_size=1000):
+    """
+    Startup sweeper: every report still at processing 0 or 1 gets a job, so
+    work lost before the job queue existed (or before a crash) is picked up.
+    """
+    projection = {f: 1 for f in JOB_PAYLOAD_FIELDS}
+    reports = []
+    recovered = 0
+    async for report in db.reports.find({"processing": {"$in": [0, 1, None]}}, projection):
+        reports.append(report)
+        if len(reports) >= chunk_size:
+            await enqueue_jobs(db, reports)
+            recovered += len(reports)
+            reports = []
+    await enqueue_jobs(db, reports)
+    recovered += len(reports)
+    if recovered:
+        print(f"🧹 Ensured jobs for {recovered} unprocessed reports")
+
+
+async def job_stats(db):
+    counts = {"queued": 0, "running": 0, "done": 0, "dead": 0}
+    async for row in db.jobs.aggregate([{"$group": {"_id": "$state", "n": {"$sum": 1}}}]):
+        counts[row["_id"]] = row["n"]
+    return counts
+
+
+class JobWorker:
+    """
+    Claims jobs from the `jobs` collection in batches and runs
+    `handler(report)` for up to `concurrency` of them at once. `report` is
+    the job payload plus `_id`; whatever the handler returns is stored as
+    the job's `result`, and `on_complete(job_id, result)` is called once
+    that completion is on the server - and only if the job was still held
+    under this worker's claim, so a job whose lease expired is never
+    counted twice. Leases are renewed in one update_many
+    per heartbeat and completions go out through a shared bulk_write.
+    """
+
+    def __init__(self, handler, on_complete=None, concurrency=JOB_CONCURRENCY, claim_batch=JOB_CLAIM_BATCH):
+        self.handler = handler
+        self.on_complete = on_complete
+        self.concurrency = max(1, concurrency)
+        self.claim_batch = max(1, claim_batch)
+        self.completions = BulkWriter("jobs")
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.running = {}
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    def notify(self):
+        """Called after enqueueing so idle workers don't wait for the next poll."""
+        self._wakeup.set()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._claim_loop()),
+                asyncio.create_task(self._heartbeat_loop()),
+                asyncio.create_task(self._sweep_loop()),
+            ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        in_flight = list(self.running.values())
+        for task in in_flight:
+            task.cancel()
+        await asyncio.gather(*self._tasks, *in_flight, return_exceptions=True)
+        self._tasks = []
+        if database.db is not None:
+            await self.completions.flush()
+            await release_jobs(database.db, self.worker_id, list(self.running))
+        self.running.clear()
+
+    async def _claim_loop(self):
+        while True:
+            db = database.db
+            jobs = []
+            free = self.concurrency - len(self.running)
+            if db is not None and free > 0:
+                try:
+                    jobs = await claim_jobs(db, self.worker_id, min(free, self.claim_batch))
+                except Exception as e:
+                    print("❌ Failed to claim jobs:", e)
+            for job in jobs:
+                self.running[job["_id"]] = asyncio.create_task(self._run_job(db, job))
+            if jobs:
+                continue
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_job(self, db, job):
+        try:
+            result = await self.handler({"_id": job["_id"], **(job.get("report") or {})})
+            completed = await self.completions.write(complete_job_op(job, result))
+            if completed is None:  # only part of the completion batch matched
+                completed = await completed_under_claim(db, job)
+            if not completed:
+                print(f"⚠️ Job {job['_id']} lost its lease before completing; result discarded")
+            elif self.on_complete:
+                self.on_complete(job["_id"], result)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Job {job['_id']} failed (attempt {job['attempts']}):", e)
+            try:
+                await fail_job(db, job, str(e))
+            except Exception as e:
+                print(f"❌ Could not record failure of job {job['_id']}:", e)
+        self.running.pop(job["_id"], None)
+        self._wakeup.set()
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+            if database.db is not None:
+                try:
+                    await heartbeat_jobs(database.db, self.worker_id, list(self.running))
+                except Exception as e:
+                    print("❌ Job heartbeat failed:", e)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(JOB_SWEEP_SECONDS)
+            if database.db is not None:
+                try:
+                    await sweep_expired_leases(database.db)
+                except Exception as e:
+                    print("❌ Job sweep failed:", e)
@@ -2,12 +2,19 @@ import torch, os, time
 from transformers import AutoModelForSequenceClassification, AutoTokenizer
 from sentence_transformers import SentenceTransformer
 from huggingface_hub import constants
+from utils.embeddings import EMBEDDING_MODEL
 
 os.environ["HF_HUB_DOWNLOAD_TIMEOUT"] = "300"
 constants.HF_HUB_DOWNLOAD_TIMEOUT = 300
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
+# Intra-op threads per forward pass. Keep TORCH_NUM_THREADS * INFERENCE_WORKERS
+# at or below the number of cores so executor threads don't oversubscribe.
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", "0"))
+if TORCH_NUM_THREADS > 0:
+    torch.set_num_threads(TORCH_NUM_THREADS)
+
 def load_model_with_retry(loader_func, model_name, max_retries=5, retry_delay=10):
     for attempt in range(max_retries):
         try:
@@ -19,7 +26,7 @@ def load_model_with_retry(loader_func, model_name, max_retries=5, retry_delay=10
                 raise e
 
 # Load all models once
-embedder = load_model_with_retry(lambda: SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2", device=device), "Embedder")
+embedder = load_model_with_retry(lambda: SentenceTransformer(EMBEDDING_MODEL, device=device), "Embedder")
 sent_tokenizer = AutoTokenizer.from_pretrained("cardiffnlp/twitter-roberta-base-sentiment-latest")
 sent_model = AutoModelForSequenceClassification.from_pretrained("cardiffnlp/twitter-roberta-base-sentiment-latest").to(device)
 z_tokenizer = AutoTokenizer.from_pretrained("facebook/bart-large-mnli")
@@ -29,14 +36,19 @@ TAG_LABELS = [
     "water purity and contamination", "road potholes and cracks", "non-functional street light outage",
     "irregular garbage pickup schedule", "frequent power cuts and load shedding", "bus/train delays and cancellations"
 ]
+HYPOTHESES = [f"This issue is related to {label}." for label in TAG_LABELS]
+
+SENTIMENT_LABELS = ["negative", "neutral", "positive"]
 
 def sentiment(text):
-    tokens = sent_tokenizer(text, return_tensors="pt", truncation=True, padding=True).to(device)
+    return sentiment_batch([text])[0]
+
+def sentiment_batch(texts):
+    tokens = sent_tokenizer(texts, return_tensors="pt", truncation=True, padding=True).to(device)
     with torch.no_grad():
         output = sent_model(**tokens)
-    scores = output.logits.softmax(dim=1).detach().cpu().numpy()[0]
-    labels = ["negative", "neutral", "positive"]
-    return labels[int(scores.argmax())], float(scores.max())
+    scores = output.logits.softmax(dim=1).detach().cpu().numpy()
+    return [(SENTIMENT_LABELS[int(row.argmax())], float(row.max())) for row in scores]
 
 def urgency_score(text):
     text = text.lower()
@@ -49,16 +61,25 @@ def urgency_score(text):
     return "LOW_LEVEL_0", 0
 
 def zero_shot(text):
-    hypothesis_templates = [f"This issue is related to {label}." for label in TAG_LABELS]
-    probs = []
-    for hyp in hypothesis_templates:
-        tokens = z_tokenizer(text, hyp, return_tensors="pt", truncation=True).to(device)
-        with torch.no_grad():
-            logits = z_model(**tokens).logits
-        entailment_prob = logits.softmax(dim=1)[0, 2].item()
-        probs.append((hyp, entailment_prob))
-    top = sorted(probs, key=lambda x: x[1], reverse=True)[:3]
-    return [[t[0].replace("This issue is related to ", "").strip("."), round(t[1], 3)] for t in top]
+    return zero_shot_batch([text])[0]
+
+def zero_shot_batch(texts):
+    # Every (premise, hypothesis) pair of every text is tokenized together and
+    # scored in one padded forward pass: row i * len(TAG_LABELS) + j holds
+    # text i against hypothesis j.
+    premises = [text for text in texts for _ in HYPOTHESES]
+    hypotheses = HYPOTHESES * len(texts)
+    tokens = z_tokenizer(premises, hypotheses, return_tensors="pt", truncation=True, padding=True).to(device)
+    with torch.no_grad():
+        logits = z_model(**tokens).logits
+    entailment_probs = logits.softmax(dim=1)[:, 2].view(len(texts), len(TAG_LABELS))
+
+    k = min(3, len(TAG_LABELS))
+    top_probs, top_idx = entailment_probs.topk(k, dim=1)
+    return [
+        [[TAG_LABELS[i], round(p, 3)] for i, p in zip(idx_row, prob_row)]
+        for idx_row, prob_row in zip(top_idx.tolist(), top_probs.tolist())
+    ]
 
 def calculate_priority(s_label, s_conf, u_score, rating):
     raw = u_score + (5 - rating) + (2 if s_label == "negative" else 0)
@@ -68,19 +89,29 @@ def calculate_priority(s_label, s_conf, u_score, rating):
     return "P4_LOW", raw
 
 def model_output_from_text(text, rating=3):
-    s_label, s_conf = sentiment(text)
-    u_label, u_score = urgency_score(text)
-    p_label, p_raw = calculate_priority(s_label, s_conf, u_score, rating)
-    tags = zero_shot(text)
-    emb = embedder.encode(text, convert_to_tensor=False).tolist()
-
-    return {
-        # "embedding": emb,
-        "sentiment": s_label,
-        "sentiment_confidence": round(s_conf, 3),
-        "urgency_label": u_label,
-        "urgency_score": u_score,
-        "priority_label": p_label,
-        "priority_raw_score": p_raw,
-        "tags_with_confidence": tags
-    }
+    return model_outputs_from_texts([text], [rating])[0]
+
+def model_outputs_from_texts(texts, ratings):
+    """
+    Batched version of model_output_from_text: every model runs once over
+    the whole list of texts instead of once per text.
+    """
+    sentiments = sentiment_batch(texts)
+    tags = zero_shot_batch(texts)
+    embs = embedder.encode(texts, batch_size=len(texts), convert_to_numpy=True, normalize_embeddings=True)
+
+    outputs = []
+    for text, rating, (s_label, s_conf), text_tags, emb in zip(texts, ratings, sentiments, tags, embs):
+        u_label, u_score = urgency_score(text)
+        p_label, p_raw = calculate_priority(s_label, s_conf, u_score, rating)
+        outputs.append({
+            "embedding": emb,  # float32 array, packed by utils/embeddings before storing
+            "sentiment": s_label,
+            "sentiment_confidence": round(s_conf, 3),
+            "urgency_label": u_label,
+            "urgency_score": u_score,
+            "priority_label": p_label,
+            "priority_raw_score": p_raw,
+            "tags_with_confidence": text_tags
+        })
+    return outputs
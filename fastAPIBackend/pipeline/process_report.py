@@ -1,49 +1,95 @@
 # pipeline/process_report.py
-from bson import ObjectId
+from datetime import datetime
+from pymongo import UpdateOne
 import database  # ✅ import the module, not just the variable
 from pipeline.nlp_cleaning import clean_with_nlp
-from pipeline.model_output import model_output_from_text
-from utils.stats_updater import update_global_stats
+from pipeline.inference_queue import batcher
+from pipeline.executor import nlp_executor, ann_executor
+from utils.stats_updater import stats_delta
+from utils.stats_aggregator import stats_aggregator
+from utils.analytics_cube import cube_dims
+from utils.stats_sketches import sketch_values
+from utils.geo import parse_device_location
+from utils.bulk_writer import BulkWriter
+from utils.embeddings import encode_embedding
+from utils.ann_index import ann_index
+from utils.versions import versions
 
+# Final stage results of many reports go out together as one bulk_write.
+report_writer = BulkWriter("reports")
 
-async def process_report(report_id: str):
+
+async def process_report(report: dict):
     """
-    Background task that processes a report in multiple stages:
+    Job handler (see pipeline/job_queue.py) that processes a report in multiple stages:
     1. Cleans the text using NLP.
     2. Runs model inference on the cleaned text.
-    3. Updates aggregate stats in the database.
+    3. Saves both results with a single (batched) write.
+    4. Returns the report's stats delta as the job result; the stats
+       themselves are written behind by the stats aggregator (see record_stats).
+
+    `report` is the payload the API stored with the job, so the report
+    itself is only read back for jobs enqueued without one.
     """
     db = database.db  # ✅ always get it from the initialized global
     if db is None:
-        print("❌ Database not initialized!")
-        return
+        raise RuntimeError("Database not initialized")
+
+    report_id = report["_id"]
 
-    # --- STEP 0: Fetch report ---
-    report = await db.reports.find_one({"_id": ObjectId(report_id)})
-    if not report:
-        print(f"⚠️ Report {report_id} not found in database")
-        return
+    # --- STEP 0: Fetch report (legacy jobs without a payload only) ---
+    if report.get("comment") is None:
+        report = await db.reports.find_one({"_id": report_id})
+        if not report:
+            print(f"⚠️ Report {report_id} not found in database")
+            return
 
     print(f"🔄 Processing report {report_id}")
 
     # --- STEP 1: NLP Cleaning ---
-    cleaned = clean_with_nlp(report["comment"])
-    await db.reports.update_one(
-        {"_id": ObjectId(report_id)},
-        {"$set": {"cleaned_comment": cleaned, "processing": 1}}
-    )
-    print(f"✅ Step 1 complete: cleaned text saved")
-
-    # --- STEP 2: Model Output ---
-    model_out = model_output_from_text(cleaned, report.get("rating", 3))
-    await db.reports.update_one(
-        {"_id": ObjectId(report_id)},
-        {"$set": {"_model_output": model_out, "processing": 2}}
-    )
-    print(f"✅ Step 2 complete: model output saved")
-
-    # --- STEP 3: Update Stats ---
-    await update_global_stats(model_out, report["public_service"], report["rating"], report["district"])
-    print(f"✅ Step 3 complete: stats updated for {report['public_service']} ({report['district']})")
-
-    print(f"🎉 Report {report_id} fully processed!\n")
\ No newline at end of file
+    cleaned = await nlp_executor.run(clean_with_nlp, report["comment"])
+
+    # --- STEP 2: Model Output (micro-batched with other pending reports) ---
+    model_out = await batcher.submit(cleaned, report.get("rating", 3))
+    embedding = model_out.pop("embedding")
+
+    # --- STEP 2b: Near-duplicate check against earlier reports ---
+    duplicate = None
+    if ann_index.ready:
+        duplicate = await ann_executor.run(
+            ann_index.find_duplicate, embedding, report["public_service"], report["district"], report_id,
+        )
+
+    # --- STEP 3: Save results once ---
+    results = {
+        "cleaned_comment": cleaned,
+        "_model_output": model_out,
+        "embedding": encode_embedding(embedding),
+        "is_duplicate": duplicate is not None,
+        "processing": 2,
+        "processed_at": datetime.utcnow(),
+    }
+    if duplicate is not None:
+        # stored as the string id, like the ids the API returns
+        results["duplicate_of"], results["duplicate_similarity"] = str(duplicate[0]), round(duplicate[1], 4)
+    await report_writer.write(UpdateOne({"_id": report_id}, {"$set": results}))
+    versions.bump("reports:processed")
+    ann_index.add(report_id, embedding, report["public_service"], report["district"])
+    ann_index.maybe_train()
+    print(f"✅ Cleaned text and model output saved" + (f" (duplicate of {duplicate[0]})" if duplicate else ""))
+
+    # --- STEP 4: Stats delta, applied once the job completion is durable ---
+    delta = stats_delta(model_out, report["public_service"], report["rating"], report["district"],
+                        results["processed_at"])
+    delta["cube"] = cube_dims(report, model_out)
+    delta["sketch"] = sketch_values(report, model_out, results["processed_at"])
+    delta["location"] = parse_device_location(report.get("device_location"))
+
+    print(f"🎉 Report {report_id} fully processed!\n")
+    return {"stats": delta}
+
+
+def record_stats(job_id, result):
+    """JobWorker on_complete hook: hands a finished report's stats delta to the aggregator."""
+    if result and result.get("stats"):
+        stats_aggregator.add(job_id, result["stats"])
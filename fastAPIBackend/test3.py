@@ -1,8 +1,10 @@
 import asyncio
 import aiohttp
+import json
 import requests
 
 API_URL = "http://127.0.0.1:8000/report"
+BULK_API_URL = "http://127.0.0.1:8000/reports/bulk"
 
 # ✅ Your dataset (example structure — replace with your real list)
 reports_data = [
@@ -2425,9 +2427,21 @@ def send_report(report):
         raise e  
 
 
+def send_bulk(reports):
+    # 🚀 One request for the whole dataset, streamed as NDJSON
+    body = "\n".join(json.dumps(r) for r in reports)
+    response = requests.post(BULK_API_URL, data=body.encode("utf-8"),
+                             headers={"Content-Type": "application/x-ndjson"})
+    response.raise_for_status()
+    result = response.json()
+    print(f"✅ Accepted {result['accepted']} reports, rejected {result['rejected']}")
+    for r in result["results"]:
+        if r["status"] == "rejected":
+            print(f"❌ Line {r['line']}:", r["error"])
+
+
 def main():
-    for report in reports_data:
-        send_report(report)  # 🚀 Request only goes AFTER previous finishes
+    send_bulk(reports_data)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,96 @@
+# utils/analytics_cube.py
+from collections import Counter
+from pymongo import UpdateOne
+from utils.stats_updater import SENTIMENTS, field_key
+
+# Every processed report lands in exactly one cube cell: the combination of
+# all these dimensions. Cells hold counts, rating sums and sentiment counts,
+# so any group-by / filter over a subset of dimensions is a $group over the
+# (few) matching cells instead of a scan of the reports.
+CUBE_DIMENSIONS = [
+    "district", "public_service", "sentiment", "city", "gender",
+    "age_bucket", "priority_label", "urgency_label", "top_tag",
+]
+AGE_BUCKETS = [(18, "<18"), (25, "18-24"), (35, "25-34"), (45, "35-44"), (55, "45-54"), (65, "55-64")]
+UNKNOWN = "unknown"
+
+
+def age_bucket(age):
+    if age is None:
+        return UNKNOWN
+    for upper, label in AGE_BUCKETS:
+        if age < upper:
+            return label
+    return "65+"
+
+
+def cube_dims(report, model_output):
+    tags = model_output.get("tags_with_confidence") or []
+    dims = {
+        "district": report.get("district"),
+        "public_service": report.get("public_service"),
+        "sentiment": model_output.get("sentiment"),
+        "city": report.get("city"),
+        "gender": (report.get("gender") or "").strip().lower() or None,
+        "age_bucket": age_bucket(report.get("age")),
+        "priority_label": model_output.get("priority_label"),
+        "urgency_label": model_output.get("urgency_label"),
+        "top_tag": tags[0][0] if tags else None,
+    }
+    return {k: (v if v not in (None, "") else UNKNOWN) for k, v in dims.items()}
+
+
+class CubeRollup:
+    """Stats aggregator rollup that accumulates cube cell deltas between flushes."""
+
+    collection = "analytics_cube"
+
+    def __init__(self):
+        self._cells = {}
+
+    def add(self, delta):
+        dims = delta.get("cube")
+        if not dims:
+            return
+        key = tuple(dims.get(d, UNKNOWN) for d in CUBE_DIMENSIONS)
+        cell = self._cells.setdefault(key, Counter())
+        cell["count"] += 1
+        cell["rating_sum"] += delta["rating"]
+        cell[f"sentiment.{field_key(dims.get('sentiment', UNKNOWN))}"] += 1
+
+    def take_ops(self):
+        cells, self._cells = self._cells, {}
+        return [
+            UpdateOne(
+                {"_id": "|".join(str(v) for v in key)},
+                {"$inc": dict(inc), "$setOnInsert": {"dims": dict(zip(CUBE_DIMENSIONS, key))}},
+                upsert=True,
+            )
+            for key, inc in cells.items()
+        ]
+
+
+async def query_cube(db, group_by, filters):
+    """
+    Groups the precomputed cells by `group_by` (a subset of CUBE_DIMENSIONS)
+    after keeping only cells matching `filters` ({dimension: [values]}).
+    """
+    match = {f"dims.{d}": {"$in": values} for d, values in filters.items()}
+    group = {
+        "_id": {d: f"$dims.{d}" for d in group_by},
+        "count": {"$sum": "$count"},
+        "rating_sum": {"$sum": "$rating_sum"},
+    }
+    for s in SENTIMENTS:
+        group[s] = {"$sum": {"$ifNull": [f"$sentiment.{s}", 0]}}
+    pipeline = [{"$match": match}, {"$group": group}, {"$sort": {"count": -1}}]
+
+    rows = []
+    async for row in db.analytics_cube.aggregate(pipeline):
+        rows.append({
+            **row["_id"],
+            "count": row["count"],
+            "avg_rating": round(row["rating_sum"] / row["count"], 2) if row["count"] else 0.0,
+            "sentiment_counts": {s: row[s] for s in SENTIMENTS},
+        })
+    return rows
@@ -0,0 +1,263 @@
+# utils/ann_index.py
+import asyncio, os, time
+import numpy as np
+from utils.embeddings import EMBEDDING_DIM, EMBEDDING_VERSION, decode_embedding
+
+# The index is exact (flat) until IVF_MIN_TRAIN vectors exist, then becomes
+# an inverted file: vectors are bucketed under sqrt(N) k-means centroids, N
+# being the size at the last training, and a query only scans the IVF_NPROBE
+# closest buckets. Lists grow until the index is IVF_RETRAIN_GROWTH times its
+# trained size, so at 1M vectors the layout was trained on at least ~670k:
+# ~820 lists of at most ~1200 vectors, a query scans ~10k of them.
+# Vectors are kept as float32 (1.5 KB each) so queries never cast.
+IVF_MIN_TRAIN = int(os.getenv("IVF_MIN_TRAIN", "20000"))
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "8"))
+IVF_RETRAIN_GROWTH = float(os.getenv("IVF_RETRAIN_GROWTH", "1.5"))
+DUPLICATE_THRESHOLD = float(os.getenv("DUPLICATE_THRESHOLD", "0.92"))
+
+
+class _VectorList:
+    """
+    Append-only float32 matrix with amortized growth, plus ids and group
+    codes. Readers take len() first and then slice: rows below that length
+    are never written again, even when add() moves the list to a bigger array.
+    """
+
+    def __init__(self, capacity=64):
+        self.vectors = np.empty((capacity, EMBEDDING_DIM), dtype=np.float32)
+        self.groups = np.empty(capacity, dtype=np.int32)
+        self.ids = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, report_id, vector, group):
+        n = len(self.ids)
+        if n == len(self.vectors):
+            self.vectors = np.resize(self.vectors, (max(64, 2 * n), EMBEDDING_DIM))
+            self.groups = np.resize(self.groups, max(64, 2 * n))
+        self.vectors[n] = vector
+        self.groups[n] = group
+        self.ids.append(report_id)
+
+    @classmethod
+    def from_arrays(cls, ids, vectors, groups):
+        """Wraps (views of) full arrays without copying; the first add moves the list to its own array."""
+        lst = cls(0)
+        lst.vectors, lst.groups, lst.ids = vectors, groups, ids
+        return lst
+
+
+def _kmeans(sample, k, iterations=10, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        for c in range(k):
+            members = sample[assign == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+            else:
+                centroids[c] = sample[rng.integers(len(sample))]
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-12
+    return centroids
+
+
+class EmbeddingIndex:
+    """
+    In-process approximate nearest-neighbour index over the L2-normalized
+    report embeddings (cosine similarity = dot product). Vectors carry a
+    group code, (public_service, district), so searches can be restricted
+    to reports about the same service in the same place.
+    """
+
+    def __init__(self):
+        # (centroids, lists) swapped as one, so searches running on the
+        # executor always see a consistent layout while training replaces it
+        self.layout = (None, [_VectorList()])
+        self.size = 0
+        self.trained_size = 0
+        self.ready = False
+        self._group_codes = {}
+        self._training = False
+        self._train_task = None
+        self._added_while_training = []
+
+    def group_code(self, service, district):
+        return self._group_codes.setdefault((service, district), len(self._group_codes))
+
+    def _list_for(self, vector):
+        centroids, lists = self.layout
+        if centroids is None:
+            return lists[0]
+        return lists[int(np.argmax(centroids @ vector))]
+
+    def add(self, report_id, vector, service=None, district=None):
+        vector = np.asarray(vector, dtype=np.float32)
+        group = self.group_code(service, district)
+        self._list_for(vector).add(report_id, vector, group)
+        self.size += 1
+        if self._training:
+            self._added_while_training.append((report_id, vector, group))
+
+    def search(self, vector, k=10, service=None, district=None, exclude=None):
+        """
+        Returns [(report_id, similarity)] best first. CPU-bound: the API and
+        the pipeline run it on ann_executor, concurrently with add().
+        """
+        if self.size == 0:
+            return []
+        vector = np.asarray(vector, dtype=np.float32)
+        centroids, lists = self.layout
+        if centroids is None:
+            probed = lists
+        else:
+            nprobe = min(IVF_NPROBE, len(centroids))
+            closest = np.argpartition(-(centroids @ vector), nprobe - 1)[:nprobe]
+            probed = [lists[i] for i in closest]
+
+        sims, groups, ids = [], [], []
+        for lst in probed:
+            n = len(lst)
+            if n:
+                sims.append(lst.vectors[:n] @ vector)
+                groups.append(lst.groups[:n])
+                ids.extend(lst.ids[:n])
+        if not ids:
+            return []
+        sims = np.concatenate(sims)
+        if service is not None or district is not None:
+            group = self._group_codes.get((service, district))
+            if group is None:
+                return []
+            sims[np.concatenate(groups) != group] = -np.inf
+
+        # a little headroom for the excluded id and repeated adds of the same report
+        want = min(len(ids), k + 4)
+        top = np.argpartition(-sims, want - 1)[:want]
+        top = top[np.argsort(-sims[top])]
+        results, seen = [], set()
+        for i in top:
+            if np.isfinite(sims[i]) and ids[i] != exclude and ids[i] not in seen:
+                seen.add(ids[i])
+                results.append((ids[i], float(sims[i])))
+        return results[:k]
+
+    def find_duplicate(self, vector, service, district, exclude=None, threshold=DUPLICATE_THRESHOLD):
+        best = self.search(vector, k=1, service=service, district=district, exclude=exclude)
+        if best and best[0][1] >= threshold:
+            return best[0]
+        return None
+
+    def needs_training(self):
+        return not self._training and self.size >= IVF_MIN_TRAIN and (
+            self.trained_size == 0 or self.size >= IVF_RETRAIN_GROWTH * self.trained_size
+        )
+
+    def _train(self, snapshot):
+        """
+        Builds a fresh IVF layout from the first n vectors of every list in
+        `snapshot` (runs in a worker thread; later adds are replayed by train).
+        Vectors are copied once, straight into one array ordered by list,
+        and every new list is a view of its slice of it.
+        """
+        ids = [rid for lst, n in snapshot for rid in lst.ids[:n]]
+        total = len(ids)
+        nlist = max(1, int(np.sqrt(total)))
+        rng = np.random.default_rng(0)
+        picks = np.sort(rng.choice(total, min(total, 40 * nlist), replace=False))
+        sample, groups, assign = [], [], []
+        start = 0
+        for lst, n in snapshot:
+            picked = picks[(picks >= start) & (picks < start + n)] - start
+            sample.append(lst.vectors[picked])
+            groups.append(lst.groups[:n])
+            start += n
+        centroids = _kmeans(np.concatenate(sample), nlist)
+        groups = np.concatenate(groups)
+
+        for lst, n in snapshot:
+            for chunk in range(0, n, 65536):
+                assign.append(np.argmax(lst.vectors[chunk:min(n, chunk + 65536)] @ centroids.T, axis=1))
+        assign = np.concatenate(assign)
+        order = np.argsort(assign, kind="stable")
+        position = np.empty(total, dtype=np.int64)
+        position[order] = np.arange(total)
+        vectors = np.empty((total, EMBEDDING_DIM), dtype=np.float32)
+        start = 0
+        for lst, n in snapshot:
+            vectors[position[start:start + n]] = lst.vectors[:n]
+            start += n
+        groups = groups[order]
+
+        bounds = np.searchsorted(assign[order], np.arange(nlist + 1))
+        lists = [
+            _VectorList.from_arrays([ids[i] for i in order[lo:hi]], vectors[lo:hi], groups[lo:hi])
+            for lo, hi in zip(bounds[:-1], bounds[1:])
+        ]
+        return centroids, lists, total
+
+    def maybe_train(self):
+        """
+        Starts a background retraining when one is due and returns its task
+        (or the one already running, or None). Training is claimed and the
+        snapshot taken synchronously, so callers woken together never start
+        a second one and every later add is replayed exactly once.
+        """
+        if self.needs_training():
+            self._training = True
+            self._added_while_training = []
+            snapshot = [(lst, len(lst)) for lst in self.layout[1]]
+            self._train_task = asyncio.create_task(self._retrain(snapshot))
+        return self._train_task if self._training else None
+
+    async def train(self):
+        """Waits for the training in progress, if any, then trains again for as long as one is due."""
+        while (task := self.maybe_train()) is not None:
+            await task
+
+    async def _retrain(self, snapshot):
+        try:
+            start = time.perf_counter()
+            centroids, lists, trained = await asyncio.to_thread(self._train, snapshot)
+            pending = self._added_while_training
+            self.layout, self.trained_size = (centroids, lists), trained
+            self.size = trained
+            for report_id, vector, group in pending:
+                self._list_for(vector).add(report_id, vector, group)
+                self.size += 1
+            print(f"🧭 ANN index trained: {len(lists)} lists over {trained} vectors in {time.perf_counter() - start:.1f}s")
+        except Exception as e:
+            print("❌ ANN index training failed:", e)
+        finally:
+            self._training = False
+            self._added_while_training = []
+
+    def stats(self):
+        return {
+            "ready": self.ready,
+            "size": self.size,
+            "lists": len(self.layout[1]),
+            "trained_size": self.trained_size,
+            "nprobe": IVF_NPROBE,
+        }
+
+
+async def build_index(db, index):
+    """Loads every stored embedding of the current version, then trains the IVF layout."""
+    start = time.perf_counter()
+    cursor = db.reports.find(
+        {"embedding.version": EMBEDDING_VERSION},
+        {"embedding": 1, "public_service": 1, "district": 1},
+        batch_size=5000,
+    )
+    async for doc in cursor:
+        vector = decode_embedding(doc.get("embedding"))
+        if vector is not None:
+            index.add(doc["_id"], vector, doc.get("public_service"), doc.get("district"))
+    await index.train()
+    index.ready = True
+    print(f"🧭 ANN index ready with {index.size} vectors ({time.perf_counter() - start:.1f}s)")
+
+
+ann_index = EmbeddingIndex()
@@ -0,0 +1,118 @@
+# utils/bulk_ingest.py
+import json, os
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+from models import Report
+from utils.geo import with_location
+
+# Reports are written to Mongo in insert_many chunks of this size.
+BULK_INSERT_BATCH = int(os.getenv("BULK_INSERT_BATCH", "500"))
+# A JSON array has to be held in memory until it is complete; NDJSON streams.
+BULK_MAX_ARRAY_BYTES = int(os.getenv("BULK_MAX_ARRAY_BYTES", str(16 * 1024 * 1024)))
+# An NDJSON line is held until its newline arrives.
+BULK_MAX_LINE_BYTES = int(os.getenv("BULK_MAX_LINE_BYTES", str(1024 * 1024)))
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+async def iter_bulk_records(request):
+    """
+    Yields (line_no, raw_text) for every record of a bulk upload.
+    NDJSON bodies are split while streaming; a body starting with '[' is
+    treated as a JSON array and yields one record per element. Arrays larger
+    than BULK_MAX_ARRAY_BYTES raise BodyTooLarge before any record is yielded,
+    NDJSON lines longer than BULK_MAX_LINE_BYTES raise it when reached.
+    """
+    buffer = bytearray()
+    line_no = 0
+    is_array = None
+
+    async for chunk in request.stream():
+        buffer += chunk
+        if is_array is None:
+            stripped = buffer.lstrip()
+            if not stripped:
+                continue
+            is_array = stripped.startswith(b"[")
+        if is_array:
+            # arrays can only be split once fully received
+            if len(buffer) > BULK_MAX_ARRAY_BYTES:
+                raise BodyTooLarge(
+                    f"JSON array bodies are limited to {BULK_MAX_ARRAY_BYTES} bytes; "
+                    "send large uploads as NDJSON (one report per line)"
+                )
+            continue
+
+        end = buffer.rfind(b"\n")
+        lines = buffer[:end].split(b"\n") if end >= 0 else []
+        del buffer[:end + 1]
+        for line in lines:
+            line_no += 1
+            if len(line) > BULK_MAX_LINE_BYTES:
+                raise _line_too_large(line_no)
+            if line.strip():
+                yield line_no, line.decode("utf-8", errors="replace")
+        if len(buffer) > BULK_MAX_LINE_BYTES:  # the unfinished last line
+            raise _line_too_large(line_no + 1)
+
+    if is_array:
+        try:
+            items = json.loads(buffer)
+        except ValueError as e:
+            yield 1, e
+            return
+        if not isinstance(items, list):
+            yield 1, ValueError("Expected a JSON array of reports")
+            return
+        for i, item in enumerate(items, start=1):
+            yield i, item
+    elif buffer.strip():
+        yield line_no + 1, buffer.decode("utf-8", errors="replace")
+
+
+def _line_too_large(line_no):
+    return BodyTooLarge(f"Line {line_no} is longer than {BULK_MAX_LINE_BYTES} bytes; "
+                        "NDJSON uploads need one report per line")
+
+
+def parse_record(raw):
+    """Returns the validated report document, or raises ValueError."""
+    if isinstance(raw, Exception):
+        raise ValueError(f"Invalid JSON: {raw}")
+    try:
+        data = json.loads(raw) if isinstance(raw, str) else raw
+        if not isinstance(data, dict):
+            raise ValueError("Expected a JSON object")
+        return with_location(Report(**data).dict())
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON: {e}") from e
+    except (ValidationError, TypeError) as e:
+        raise ValueError(str(e)) from e
+
+
+async def insert_reports(db, batch):
+    """
+    Writes a list of (line_no, doc) with one unordered insert_many.
+    Returns (accepted, rejected) where accepted is [(line_no, doc)] with the
+    inserted _id set on each doc and rejected is [(line_no, error)].
+    """
+    if not batch:
+        return [], []
+
+    docs = [doc for _, doc in batch]
+    failed = {}
+    try:
+        await db.reports.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        for err in e.details.get("writeErrors", []):
+            failed[err["index"]] = err.get("errmsg", "write error")
+
+    accepted, rejected = [], []
+    for i, (line_no, doc) in enumerate(batch):
+        if i in failed:
+            rejected.append((line_no, failed[i]))
+        else:
+            accepted.append((line_no, doc))
+    return accepted, rejected
@@ -0,0 +1,88 @@
+# utils/bulk_writer.py
+import asyncio, os
+from pymongo.errors import BulkWriteError
+import database
+
+BULK_WRITE_MAX_OPS = int(os.getenv("BULK_WRITE_MAX_OPS", "200"))
+BULK_WRITE_MAX_WAIT_MS = float(os.getenv("BULK_WRITE_MAX_WAIT_MS", "50"))
+
+
+class BulkWriter:
+    """
+    Buffers write operations for one collection and sends them as a single
+    unordered bulk_write once `max_ops` are waiting or `max_wait_ms` after the
+    first one arrived. write() returns only after its operation is on the
+    server, so callers can rely on it being durable.
+
+    write() also reports whether its operation matched a document (inserts
+    and upserts always do): True or False when the batch's counts settle
+    it - every op hit, or none did - and None when only some ops of the
+    batch matched, as Mongo does not say which ones.
+    """
+
+    def __init__(self, collection_name, max_ops=BULK_WRITE_MAX_OPS, max_wait_ms=BULK_WRITE_MAX_WAIT_MS):
+        self.collection_name = collection_name
+        self.max_ops = max(1, max_ops)
+        self.max_wait = max_wait_ms / 1000
+        self._ops = []
+        self._futures = []
+        self._timer = None
+        self.flushes = 0
+        self.ops_written = 0
+
+    async def write(self, op):
+        future = asyncio.get_running_loop().create_future()
+        self._ops.append(op)
+        self._futures.append(future)
+        if len(self._ops) >= self.max_ops:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        return await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.max_wait)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self):
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+            self._timer = None
+        ops, futures = self._ops, self._futures
+        self._ops, self._futures = [], []
+        if not ops:
+            return
+
+        errors = {}
+        counts = {}
+        try:
+            result = await database.db[self.collection_name].bulk_write(ops, ordered=False)
+            counts = result.bulk_api_result
+        except BulkWriteError as e:
+            counts = e.details
+            for err in e.details.get("writeErrors", []):
+                errors[err["index"]] = RuntimeError(err.get("errmsg", "write error"))
+        except Exception as e:
+            errors = {i: e for i in range(len(ops))}
+
+        applied = len(ops) - len(errors)
+        hits = sum(counts.get(k, 0) for k in ("nInserted", "nUpserted", "nMatched", "nRemoved"))
+        matched = True if hits >= applied else (False if hits == 0 else None)
+
+        self.flushes += 1
+        self.ops_written += applied
+        for i, future in enumerate(futures):
+            if future.done():
+                continue
+            if i in errors:
+                future.set_exception(errors[i])
+            else:
+                future.set_result(matched)
+
+    def stats(self):
+        return {
+            "flushes": self.flushes,
+            "ops_written": self.ops_written,
+            "avg_ops_per_flush": round(self.ops_written / self.flushes, 2) if self.flushes else 0.0,
+        }
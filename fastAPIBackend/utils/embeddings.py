@@ -0,0 +1,39 @@
+# utils/embeddings.py
+import os
+import numpy as np
+from bson.binary import Binary
+
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_DIM = 384
+# Bump whenever the model or its preprocessing changes, so stored vectors
+# from different versions are never compared with each other.
+EMBEDDING_VERSION = "all-MiniLM-L6-v2/l2norm/v1"
+# "float16" (768 bytes, ~1e-3 error) or "int8" (384 bytes + scale, ~1e-2 error)
+EMBEDDING_DTYPE = os.getenv("EMBEDDING_DTYPE", "float16")
+
+
+def encode_embedding(vector, dtype=EMBEDDING_DTYPE):
+    """
+    Packs an L2-normalized embedding into a small BSON subdocument instead
+    of a list of 384 doubles (~3.5 KB as BSON).
+    """
+    vector = np.asarray(vector, dtype=np.float32)
+    doc = {"version": EMBEDDING_VERSION, "dim": int(vector.shape[0]), "dtype": dtype}
+    if dtype == "int8":
+        scale = float(np.abs(vector).max()) / 127 or 1.0
+        doc["scale"] = scale
+        doc["data"] = Binary(np.round(vector / scale).astype(np.int8).tobytes())
+    elif dtype == "float16":
+        doc["data"] = Binary(vector.astype(np.float16).tobytes())
+    else:
+        raise ValueError(f"Unsupported embedding dtype: {dtype}")
+    return doc
+
+
+def decode_embedding(doc):
+    """Returns the stored embedding as a float32 array, or None if unusable."""
+    if not doc or doc.get("version") != EMBEDDING_VERSION:
+        return None
+    if doc["dtype"] == "int8":
+        return np.frombuffer(doc["data"], dtype=np.int8).astype(np.float32) * doc["scale"]
+    return np.frombuffer(doc["data"], dtype=np.float16).astype(np.float32)
@@ -0,0 +1,138 @@
+# utils/geo.py
+"""
+GeoJSON locations for reports. `device_location` arrives as a "lat,lon"
+string; ingestion also stores it as `location`, a GeoJSON Point indexed with
+2dsphere, so spatial queries run in Mongo instead of parsing strings in
+Python.
+
+Reports ingested before `location` existed are backfilled with
+
+    python -m utils.geo --dry-run      # count what would be converted
+    python -m utils.geo                # convert them
+"""
+import argparse
+import asyncio
+import math
+import os
+
+from pymongo import UpdateOne, GEOSPHERE
+
+import database
+
+GEO_MIGRATION_BATCH = int(os.getenv("GEO_MIGRATION_BATCH", "1000"))
+# Polygon edges are geodesics on a sphere, not latitude lines: bbox edges get
+# a vertex every BBOX_EDGE_STEP degrees so they follow the parallel closely,
+# and boxes are split into parts at most BBOX_MAX_PART_WIDTH degrees wide so
+# no part is ambiguous (>= 180 degrees) or has coinciding vertices (+-180, poles).
+BBOX_EDGE_STEP = 0.5
+BBOX_MAX_PART_WIDTH = 90
+BBOX_MAX_LAT = 89.9999
+
+
+def parse_device_location(value):
+    """(lat, lon) from a "lat,lon" string, or None when missing or not a valid coordinate."""
+    if not value or not isinstance(value, str):
+        return None
+    try:
+        lat_str, lon_str = value.split(",")
+        lat, lon = float(lat_str.strip()), float(lon_str.strip())
+    except ValueError:
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lat, lon
+
+
+def parse_bbox(value):
+    """(west, south, east, north) from a "west,south,east,north" query string; raises ValueError."""
+    try:
+        west, south, east, north = (float(v) for v in value.split(","))
+    except ValueError:
+        raise ValueError("bbox must be 'west,south,east,north'")
+    if not (-180 <= west < east <= 180 and -90 <= south < north <= 90):
+        raise ValueError("bbox is out of range or empty")
+    return west, south, east, north
+
+
+def bbox_polygons(bbox):
+    """GeoJSON Polygons that together cover bbox (west, south, east, north) in lon/lat terms."""
+    west, south, east, north = bbox
+    south, north = max(south, -BBOX_MAX_LAT), min(north, BBOX_MAX_LAT)
+    parts = math.ceil((east - west) / BBOX_MAX_PART_WIDTH)
+    polygons = []
+    for i in range(parts):
+        lo, hi = west + (east - west) * i / parts, west + (east - west) * (i + 1) / parts
+        steps = max(1, math.ceil((hi - lo) / BBOX_EDGE_STEP))
+        lons = [lo + (hi - lo) * k / steps for k in range(steps + 1)]
+        ring = [[lon, south] for lon in lons] + [[lon, north] for lon in reversed(lons)] + [[lo, south]]
+        polygons.append({"type": "Polygon", "coordinates": [ring]})
+    return polygons
+
+
+def within_bbox(bbox, field="location"):
+    """Query clause matching documents whose GeoJSON `field` lies in bbox; merge it into the query."""
+    clauses = [{field: {"$geoWithin": {"$geometry": polygon}}} for polygon in bbox_polygons(bbox)]
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+
+def geo_point(device_location):
+    parsed = parse_device_location(device_location)
+    if parsed is None:
+        return None
+    lat, lon = parsed
+    return {"type": "Point", "coordinates": [lon, lat]}  # GeoJSON is [lon, lat]
+
+
+def with_location(doc):
+    """Adds the GeoJSON `location` of a report document (None when it has no usable device_location)."""
+    doc["location"] = geo_point(doc.get("device_location"))
+    return doc
+
+
+async def ensure_geo_indexes(db):
+    # documents whose location is null or missing are simply left out of the index
+    await db.reports.create_index([("location", GEOSPHERE)])
+
+
+async def migrate_locations(db, batch_size=GEO_MIGRATION_BATCH, dry_run=False):
+    """Sets `location` on every report that has a device_location but no location field yet."""
+    query = {"device_location": {"$type": "string"}, "location": {"$exists": False}}
+    converted = invalid = 0
+    ops = []
+    async for doc in db.reports.find(query, {"device_location": 1}, batch_size=batch_size):
+        point = geo_point(doc["device_location"])
+        if point is None:
+            invalid += 1
+        else:
+            converted += 1
+        # unparseable strings get location: null so they are not rescanned
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"location": point}}))
+        if len(ops) >= batch_size:
+            if not dry_run:
+                await db.reports.bulk_write(ops, ordered=False)
+            ops = []
+    if ops and not dry_run:
+        await db.reports.bulk_write(ops, ordered=False)
+    return converted, invalid
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Backfill GeoJSON locations on reports")
+    parser.add_argument("--dry-run", action="store_true", help="count the reports to convert, write nothing")
+    parser.add_argument("--batch", type=int, default=GEO_MIGRATION_BATCH, help="updates per bulk_write")
+    args = parser.parse_args()
+
+    await database.connect_to_mongo()
+    if database.db is None:
+        raise SystemExit("❌ Database not initialized")
+    try:
+        await ensure_geo_indexes(database.db)
+        converted, invalid = await migrate_locations(database.db, max(1, args.batch), args.dry_run)
+        verb = "Would convert" if args.dry_run else "Converted"
+        print(f"🗺️ {verb} {converted} locations ({invalid} unparseable device_location strings)")
+    finally:
+        await database.close_mongo_connection()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
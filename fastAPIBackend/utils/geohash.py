@@ -0,0 +1,77 @@
+# utils/geohash.py
+import math
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+_DECODE = {c: i for i, c in enumerate(_BASE32)}
+
+
+def encode(lat, lon, precision):
+    lat_lo, lat_hi, lon_lo, lon_hi = -90.0, 90.0, -180.0, 180.0
+    chars, bits, ch, even = [], 0, 0, True
+    while len(chars) < precision:
+        if even:
+            mid = (lon_lo + lon_hi) / 2
+            if lon >= mid:
+                ch, lon_lo = ch * 2 + 1, mid
+            else:
+                ch, lon_hi = ch * 2, mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if lat >= mid:
+                ch, lat_lo = ch * 2 + 1, mid
+            else:
+                ch, lat_hi = ch * 2, mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_BASE32[ch])
+            bits, ch = 0, 0
+    return "".join(chars)
+
+
+def bounds(cell):
+    """(south, west, north, east) of a geohash cell."""
+    lat_lo, lat_hi, lon_lo, lon_hi = -90.0, 90.0, -180.0, 180.0
+    even = True
+    for c in cell:
+        v = _DECODE[c]
+        for shift in range(4, -1, -1):
+            bit = (v >> shift) & 1
+            if even:
+                mid = (lon_lo + lon_hi) / 2
+                lon_lo, lon_hi = (mid, lon_hi) if bit else (lon_lo, mid)
+            else:
+                mid = (lat_lo + lat_hi) / 2
+                lat_lo, lat_hi = (mid, lat_hi) if bit else (lat_lo, mid)
+            even = not even
+    return lat_lo, lon_lo, lat_hi, lon_hi
+
+
+def cell_size(precision):
+    """(lat degrees, lon degrees) spanned by one cell of this precision."""
+    lon_bits = math.ceil(precision * 5 / 2)
+    lat_bits = precision * 5 - lon_bits
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def cover_count(bbox, precision):
+    west, south, east, north = bbox
+    dlat, dlon = cell_size(precision)
+    rows = math.floor((north + 90) / dlat) - math.floor((south + 90) / dlat) + 1
+    cols = math.floor((east + 180) / dlon) - math.floor((west + 180) / dlon) + 1
+    return rows * cols
+
+
+def cover(bbox, precision):
+    """Geohash cells of `precision` that intersect bbox (west, south, east, north)."""
+    west, south, east, north = bbox
+    dlat, dlon = cell_size(precision)
+    first_row, last_row = math.floor((south + 90) / dlat), math.floor((north + 90) / dlat)
+    first_col, last_col = math.floor((west + 180) / dlon), math.floor((east + 180) / dlon)
+    cells = []
+    for row in range(first_row, last_row + 1):
+        lat = min(89.999999, -90 + (row + 0.5) * dlat)
+        for col in range(first_col, last_col + 1):
+            lon = min(179.999999, -180 + (col + 0.5) * dlon)
+            cells.append(encode(lat, lon, precision))
+    return cells
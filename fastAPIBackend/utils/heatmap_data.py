@@ -0,0 +1,86 @@
+# utils/heatmap_data.py
+import numpy as np
+from utils import geohash
+from utils.geo import within_bbox
+from utils.heatmap_grid import read_grid_cells, grid_precision
+
+# Points are clustered on the server into the geohash cells of the zoom's
+# precision (see heatmap_grid.grid_precision), so a response holds at most
+# about GRID_MAX_CELLS clusters however many reports are in view.
+
+
+async def grid_clusters(db, bbox, zoom, services=None):
+    """Clusters from the precomputed heatmap_cells (all time)."""
+    filters = {"public_service": services} if services else None
+    clusters = {}
+    for cell in await read_grid_cells(db, bbox, zoom, filters):
+        c = clusters.setdefault(cell["cell"], [0, 0.0, 0.0, 0.0])
+        c[0] += cell["count"]
+        c[1] += cell["lat_sum"]
+        c[2] += cell["lon_sum"]
+        c[3] += cell["rating_sum"]
+    return [
+        {"lat": lat_sum / n, "lon": lon_sum / n, "count": n, "avg_rating": rating_sum / n}
+        for n, lat_sum, lon_sum, rating_sum in clusters.values() if n
+    ]
+
+
+async def report_clusters(db, bbox, zoom, services=None, start=None, end=None):
+    """
+    Clusters of the processed reports submitted in [start, end), grouped in
+    Mongo on the same cell grid: only one row per cell comes back.
+    """
+    dlat, dlon = geohash.cell_size(grid_precision(bbox, zoom))
+    match = {"processing": 2, **within_bbox(bbox)}
+    if services:
+        match["public_service"] = {"$in": services}
+    if start or end:
+        match["timestamp"] = {k: v for k, v in (("$gte", start), ("$lt", end)) if v is not None}
+
+    lon_expr = {"$arrayElemAt": ["$location.coordinates", 0]}
+    lat_expr = {"$arrayElemAt": ["$location.coordinates", 1]}
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": {
+                "row": {"$floor": {"$divide": [{"$add": [lat_expr, 90]}, dlat]}},
+                "col": {"$floor": {"$divide": [{"$add": [lon_expr, 180]}, dlon]}},
+            },
+            "count": {"$sum": 1},
+            "lat": {"$avg": lat_expr},
+            "lon": {"$avg": lon_expr},
+            "avg_rating": {"$avg": "$rating"},
+        }},
+    ]
+    return [
+        {"lat": row["lat"], "lon": row["lon"], "count": row["count"], "avg_rating": row["avg_rating"] or 0.0}
+        async for row in db.reports.aggregate(pipeline, allowDiskUse=True)
+    ]
+
+
+def clusters_geojson(clusters):
+    max_count = max((c["count"] for c in clusters), default=1)
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [round(c["lon"], 6), round(c["lat"], 6)]},
+                "properties": {
+                    "count": c["count"],
+                    "avg_rating": round(c["avg_rating"], 2),
+                    "weight": round(c["count"] / max_count, 4),
+                },
+            }
+            for c in clusters
+        ],
+    }
+
+
+def clusters_binary(clusters):
+    """Little-endian Float32 triples [lat, lon, weight] per cluster, weight = count / max count."""
+    if not clusters:
+        return b""
+    data = np.array([(c["lat"], c["lon"], c["count"]) for c in clusters], dtype=np.float64)
+    data[:, 2] /= data[:, 2].max()
+    return data.astype("<f4").tobytes()
@@ -0,0 +1,149 @@
+# utils/heatmap_grid.py
+"""
+Heatmap grid: per-geohash-cell counters kept up to date by the stats
+aggregator, so the heatmap reads the cells covering the visible area instead
+of every located report. Each processed report lands in one cell per
+GRID_PRECISIONS entry and per (public_service, district, sentiment).
+
+Cells of reports processed before the grid existed are built with
+
+    python -m utils.heatmap_grid            # drop and rebuild heatmap_cells
+"""
+import argparse
+import asyncio
+import os
+from collections import Counter
+
+from pymongo import UpdateOne, ASCENDING
+
+import database
+from utils import geohash
+from utils.geo import parse_device_location
+
+GRID_PRECISIONS = (3, 4, 5, 6, 7)  # ~156 km, 39 km, 4.9 km, 1.2 km and 153 m cells
+GRID_MAX_CELLS = int(os.getenv("GRID_MAX_CELLS", "4096"))
+UNKNOWN = "unknown"
+
+
+def rating_sentiment(rating):
+    """-1 / 0 / 1 score of a rating, as plotted on the heatmap markers."""
+    return 1 if rating > 3 else (0 if rating == 3 else -1)
+
+
+def precision_for_zoom(zoom):
+    """Geohash precision whose cells are a few screen pixels wide at this web-map zoom."""
+    for max_zoom, precision in ((5, 3), (8, 4), (11, 5), (14, 6)):
+        if zoom <= max_zoom:
+            return precision
+    return 7
+
+
+class GridRollup:
+    """Stats aggregator rollup that accumulates heatmap cell deltas between flushes."""
+
+    collection = "heatmap_cells"
+
+    def __init__(self):
+        self._cells = {}
+
+    def add(self, delta):
+        location = delta.get("location")
+        if not location:
+            return
+        lat, lon = location
+        facets = tuple(delta.get(k) or UNKNOWN for k in ("service", "district", "sentiment"))
+        for precision in GRID_PRECISIONS:
+            cell = self._cells.setdefault((precision, geohash.encode(lat, lon, precision)) + facets, Counter())
+            cell["count"] += 1
+            cell["rating_sum"] += delta["rating"]
+            cell["rating_score_sum"] += rating_sentiment(delta["rating"])
+            cell["lat_sum"] += lat
+            cell["lon_sum"] += lon
+
+    def take_ops(self):
+        cells, self._cells = self._cells, {}
+        return [
+            UpdateOne(
+                {"_id": "|".join(str(v) for v in key)},
+                {
+                    "$inc": dict(inc),
+                    "$setOnInsert": dict(zip(
+                        ("precision", "cell", "public_service", "district", "sentiment"), key,
+                    )),
+                },
+                upsert=True,
+            )
+            for key, inc in cells.items()
+        ]
+
+
+async def ensure_grid_indexes(db):
+    await db.heatmap_cells.create_index([("precision", ASCENDING), ("cell", ASCENDING)])
+
+
+def grid_precision(bbox, zoom):
+    """The zoom's precision, coarsened until covering bbox takes at most GRID_MAX_CELLS cells."""
+    precision = precision_for_zoom(zoom)
+    while precision > GRID_PRECISIONS[0] and geohash.cover_count(bbox, precision) > GRID_MAX_CELLS:
+        precision -= 1
+    return precision
+
+
+async def read_grid_cells(db, bbox, zoom, filters=None):
+    """
+    Cell documents covering bbox (west, south, east, north) at the zoom's
+    precision, optionally restricted by {public_service|district|sentiment: [values]}.
+    """
+    precision = grid_precision(bbox, zoom)
+    query = {"precision": precision}
+    if geohash.cover_count(bbox, precision) <= GRID_MAX_CELLS:
+        query["cell"] = {"$in": geohash.cover(bbox, precision)}
+    for field, values in (filters or {}).items():
+        query[field] = {"$in": values}
+    projection = {"_id": 0, "precision": 0}
+    return [doc async for doc in db.heatmap_cells.find(query, projection)]
+
+
+async def rebuild_grid(db):
+    rollup = GridRollup()
+    cursor = db.reports.find(
+        {"processing": 2, "device_location": {"$type": "string"}},
+        {"device_location": 1, "public_service": 1, "district": 1, "rating": 1, "_model_output.sentiment": 1},
+        batch_size=5000,
+    )
+    reports = 0
+    async for doc in cursor:
+        location = parse_device_location(doc["device_location"])
+        if location is None:
+            continue
+        rollup.add({
+            "location": location,
+            "service": doc.get("public_service"),
+            "district": doc.get("district"),
+            "sentiment": (doc.get("_model_output") or {}).get("sentiment", "neutral"),
+            "rating": doc.get("rating", 0),
+        })
+        reports += 1
+
+    ops = rollup.take_ops()
+    await db.heatmap_cells.delete_many({})
+    for i in range(0, len(ops), 5000):
+        await db.heatmap_cells.bulk_write(ops[i:i + 5000], ordered=False)
+    return reports, len(ops)
+
+
+async def main():
+    argparse.ArgumentParser(description="Rebuild the heatmap grid from processed reports").parse_args()
+    await database.connect_to_mongo()
+    if database.db is None:
+        raise SystemExit("❌ Database not initialized")
+    try:
+        await ensure_grid_indexes(database.db)
+        reports, cells = await rebuild_grid(database.db)
+        print(f"🗺️ Rebuilt {cells} heatmap cells from {reports} located reports")
+    finally:
+        await database.close_mongo_connection()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,84 @@
+# utils/mvt.py
+"""
+Minimal Mapbox Vector Tile (v2.1) encoder for point layers: just enough of
+the protobuf wire format to write Tile > Layer > Feature with POINT
+geometries and string / double / integer properties.
+"""
+import struct
+
+MVT_EXTENT = 4096
+
+_VARINT, _FIXED64, _BYTES = 0, 1, 2
+_POINT = 1
+_MOVE_TO = 1
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _key(field, wire_type):
+    return _varint((field << 3) | wire_type)
+
+
+def _bytes_field(field, payload):
+    return _key(field, _BYTES) + _varint(len(payload)) + payload
+
+
+def _uint_field(field, value):
+    return _key(field, _VARINT) + _varint(value)
+
+
+def _packed(field, values):
+    return _bytes_field(field, b"".join(_varint(v) for v in values))
+
+
+def _value(value):
+    if isinstance(value, bool):
+        return _uint_field(7, int(value))
+    if isinstance(value, int):
+        return _uint_field(6, _zigzag(value))  # sint64
+    if isinstance(value, float):
+        return _key(3, _FIXED64) + struct.pack("<d", value)
+    return _bytes_field(1, str(value).encode())
+
+
+def encode_layer(name, features, extent=MVT_EXTENT):
+    """
+    features: iterable of (x, y, properties) with x, y in tile coordinates
+    (0..extent, y down) and properties a flat dict. Keys and values are
+    shared through the layer's dictionaries as the spec requires.
+    """
+    keys, values = {}, {}
+    body = [_uint_field(15, 2), _bytes_field(1, name.encode())]
+    for feature_id, (x, y, properties) in enumerate(features, start=1):
+        tags = []
+        for k, v in properties.items():
+            if v is None:
+                continue
+            tags.append(keys.setdefault(k, len(keys)))
+            tags.append(values.setdefault((type(v), v), len(values)))
+        geometry = [(_MOVE_TO & 0x7) | (1 << 3), _zigzag(int(round(x))), _zigzag(int(round(y)))]
+        feature = _uint_field(1, feature_id) + _packed(2, tags) + _uint_field(3, _POINT) + _packed(4, geometry)
+        body.append(_bytes_field(2, feature))
+    body += [_bytes_field(3, k.encode()) for k in keys]
+    body += [_bytes_field(4, _value(v)) for _, v in values]
+    body.append(_uint_field(5, extent))
+    return b"".join(body)
+
+
+def encode_tile(layers):
+    """layers: {name: features}, see encode_layer."""
+    return b"".join(_bytes_field(3, encode_layer(name, features)) for name, features in layers.items())
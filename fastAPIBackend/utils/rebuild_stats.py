@@ -0,0 +1,226 @@
+# utils/rebuild_stats.py
+"""
+Recomputes the global and every district stats document from the processed
+reports (and, with --timeseries, the stats_timeseries buckets).
+
+    python -m utils.rebuild_stats --dry-run        # show what would change
+    python -m utils.rebuild_stats                  # write the rebuilt docs
+    python -m utils.rebuild_stats --timeseries     # also rebuild time buckets
+
+The reports collection is split into _id ranges holding about the same
+number of reports (split points come from a random $sample) and each range
+is grouped on the server by an aggregation pipeline, up to --workers ranges
+at once; the same pass counts the ratings per district. Only the small grouped cells travel back, so the
+cost is dominated by Mongo scanning the collection in parallel.
+
+Stop the API (or at least its job workers) while writing: stats flushed by a
+running aggregator during the rebuild would be overwritten. Completed jobs
+whose stats delta is not applied yet (the API died before its aggregator
+flushed) block the write: the next API start would replay them on top of the
+rebuilt counts. Start the API once so it recovers them, stop it, then rebuild.
+"""
+import argparse
+import asyncio
+import time
+from collections import Counter
+from datetime import datetime
+
+from pymongo import ReplaceOne
+
+import database
+from utils.stats_updater import stats_incs
+from utils.stats_timeseries import timeseries_inc_ops
+
+
+# _ids sampled per chunk to place the split points
+CHUNK_SAMPLE = 32
+
+
+async def _chunk_bounds(db, chunks):
+    """
+    Splits the reports into `chunks` _id ranges of about equal document
+    count, whatever their insert times (a bulk backfill lands within
+    seconds). (lo, hi) with None for an open end.
+    """
+    # $sample as the first stage reads random documents instead of scanning
+    pipeline = [{"$sample": {"size": chunks * CHUNK_SAMPLE}}, {"$project": {"_id": 1}}]
+    sample = sorted([d["_id"] async for d in db.reports.aggregate(pipeline)])
+    splits = sorted({sample[len(sample) * i // chunks] for i in range(1, chunks)}) if sample else []
+    edges = [None, *splits, None]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+async def _aggregate_chunk(db, lo, hi, with_hours):
+    """
+    (cells, rating_counts) of the processed reports with lo <= _id < hi:
+    the stats cells and {district: {rating: count}} for the exact rating counts sketch.
+    """
+    group_id = {
+        "district": "$district",
+        "service": "$public_service",
+        "sentiment": {"$ifNull": ["$_model_output.sentiment", "neutral"]},
+        "rating": "$rating",
+    }
+    if with_hours:
+        group_id["hour"] = {"$dateToString": {
+            "format": "%Y-%m-%dT%H",
+            "date": {"$ifNull": ["$processed_at", "$timestamp"]},
+        }}
+    id_range = {k: v for k, v in (("$gte", lo), ("$lt", hi)) if v is not None}
+    match = {"processing": 2, **({"_id": id_range} if id_range else {})}
+    pipeline = [
+        {"$match": match},
+        {"$group": {"_id": group_id, "count": {"$sum": 1}, "rating_sum": {"$sum": "$rating"}}},
+    ]
+    cells, rating_counts = {}, {}
+    async for row in db.reports.aggregate(pipeline, allowDiskUse=True):
+        g = row["_id"]
+        key = (g.get("district"), g.get("service"), g["sentiment"], g.get("hour") or "1970-01-01T00")
+        cell = cells.setdefault(key, [0, 0])
+        cell[0] += row["count"]
+        cell[1] += row["rating_sum"]
+        rating = g.get("rating")
+        if isinstance(rating, (int, float)) and not isinstance(rating, bool):
+            counts = rating_counts.setdefault(g.get("district"), Counter())
+            counts[str(int(round(rating)))] += row["count"]
+    return cells, rating_counts
+
+
+def _expand(dotted):
+    """{'a.b': 1} -> {'a': {'b': 1}}"""
+    doc = {}
+    for path, value in dotted.items():
+        *parents, leaf = path.split(".")
+        node = doc
+        for p in parents:
+            node = node.setdefault(p, {})
+        node[leaf] = value
+    return doc
+
+
+def build_stats_docs(cells):
+    """Full stats documents from cells, with the same field layout as the live $inc updates."""
+    docs = {}
+    for doc_id, (scope, district, inc) in stats_incs(cells).items():
+        doc = _expand(inc)
+        doc.update({"_id": doc_id, "scope": scope, "district": district})
+        docs[doc_id] = doc
+    return docs
+
+
+def _diff(old, new, prefix=""):
+    lines = []
+    for key in sorted(set(old) | set(new)):
+        if key in ("last_updated", "_id", "sketches"):
+            continue
+        a, b = old.get(key), new.get(key)
+        if isinstance(a, dict) or isinstance(b, dict):
+            lines += _diff(a or {}, b or {}, f"{prefix}{key}.")
+        elif a != b and not (isinstance(a, (int, float)) and isinstance(b, (int, float)) and abs(a - b) < 1e-6):
+            lines.append(f"    {prefix}{key}: {a} -> {b}")
+    return lines
+
+
+async def unapplied_jobs(db):
+    """Completed jobs whose stats delta StatsAggregator.recover() would still replay."""
+    return await db.jobs.count_documents({"state": "done", "stats_applied": None, "result.stats": {"$exists": True}})
+
+
+async def rebuild(chunks, workers, dry_run, with_timeseries):
+    db = database.db
+    start = time.perf_counter()
+
+    unapplied = await unapplied_jobs(db)
+    if unapplied:
+        print(f"⛔ {unapplied} completed jobs have stats that were never applied; the next API start "
+              f"would replay them on top of the rebuilt documents. Start the API once so it recovers "
+              f"them, stop it, then rebuild.")
+        if not dry_run:
+            return
+
+    if not await db.reports.find_one({"processing": 2}, {"_id": 1}):
+        print("⚠️ No processed reports found")
+        return
+
+    slots = asyncio.Semaphore(workers)
+
+    async def run(lo, hi):
+        async with slots:
+            return await _aggregate_chunk(db, lo, hi, with_timeseries)
+
+    bounds = await _chunk_bounds(db, chunks)
+    partials = await asyncio.gather(*(run(lo, hi) for lo, hi in bounds))
+
+    cells, rating_counts = {}, {}
+    for partial_cells, partial_ratings in partials:
+        for key, (count, rating_sum) in partial_cells.items():
+            cell = cells.setdefault(key, [0, 0])
+            cell[0] += count
+            cell[1] += rating_sum
+        for district, counts in partial_ratings.items():
+            rating_counts.setdefault(district, Counter()).update(counts)
+    docs = build_stats_docs(cells)
+    print(f"🔎 Aggregated {sum(c[0] for c in cells.values())} reports in {len(bounds)} chunks "
+          f"into {len(docs)} stats documents ({time.perf_counter() - start:.1f}s)")
+
+    existing = {d["_id"]: d async for d in db.stats.find({"_id": {"$in": list(docs)}})}
+    # stats documents no report maps to any more (e.g. a renamed district)
+    async for d in db.stats.find({"_id": {"$nin": list(docs)}}, {"_id": 1}):
+        print(f"  ⚠️ {d['_id']} has no processed reports (left untouched)")
+
+    changed = 0
+    for doc_id, doc in sorted(docs.items()):
+        lines = _diff(existing.get(doc_id, {}), doc)
+        if lines:
+            changed += 1
+            print(f"  {'+' if doc_id not in existing else '~'} {doc_id}")
+            print("\n".join(lines))
+    print(f"📊 {changed} of {len(docs)} stats documents differ")
+
+    if dry_run:
+        print("🧪 Dry run, nothing written")
+        return
+
+    now = datetime.utcnow()
+    ops = []
+    for doc_id, doc in docs.items():
+        doc["last_updated"] = now
+        # the other sketches cannot be rebuilt from the aggregated cells; keep them
+        sketches = dict(existing.get(doc_id, {}).get("sketches") or {})
+        if doc["scope"] == "district":
+            sketches["rating"] = {"counts": dict(rating_counts.get(doc["district"], {}))}
+        if sketches:
+            doc["sketches"] = sketches
+        ops.append(ReplaceOne({"_id": doc_id}, doc, upsert=True))
+    await db.stats.bulk_write(ops, ordered=False)
+    print(f"✅ Wrote {len(ops)} stats documents")
+
+    if with_timeseries:
+        await db.stats_timeseries.delete_many({})
+        ts_ops = timeseries_inc_ops(cells)
+        for i in range(0, len(ts_ops), 5000):
+            await db.stats_timeseries.bulk_write(ts_ops[i:i + 5000], ordered=False)
+        print(f"✅ Wrote {len(ts_ops)} time-series buckets")
+
+    print(f"🎉 Rebuild finished in {time.perf_counter() - start:.1f}s")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Rebuild stats documents from processed reports")
+    parser.add_argument("--dry-run", action="store_true", help="print the diff against the current docs, write nothing")
+    parser.add_argument("--chunks", type=int, default=64, help="number of _id ranges to aggregate")
+    parser.add_argument("--workers", type=int, default=8, help="ranges aggregated concurrently")
+    parser.add_argument("--timeseries", action="store_true", help="also rebuild stats_timeseries")
+    args = parser.parse_args()
+
+    await database.connect_to_mongo()
+    if database.db is None:
+        raise SystemExit("❌ Database not initialized")
+    try:
+        await rebuild(max(1, args.chunks), max(1, args.workers), args.dry_run, args.timeseries)
+    finally:
+        await database.close_mongo_connection()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
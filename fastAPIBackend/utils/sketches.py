@@ -0,0 +1,136 @@
+# utils/sketches.py
+import hashlib, math
+
+# Both sketches are stored as flat maps of small integers, so they can be
+# updated in place with $inc (quantile bins) and $max (HLL registers) and
+# merged by adding / taking the max key by key.
+QUANTILE_RELATIVE_ACCURACY = 0.01
+HLL_PRECISION = 10  # 1024 registers, ~3.3% standard error
+
+
+class QuantileSketch:
+    """
+    DDSketch-style quantile sketch: values fall into logarithmic bins with a
+    fixed relative accuracy, and any quantile is read back within that
+    accuracy. Merging two sketches is adding their bin counts.
+    """
+
+    field = "bins"
+    gamma = (1 + QUANTILE_RELATIVE_ACCURACY) / (1 - QUANTILE_RELATIVE_ACCURACY)
+    log_gamma = math.log(gamma)
+
+    def __init__(self, bins=None):
+        self.bins = dict(bins or {})
+
+    @classmethod
+    def key(cls, value):
+        if value <= 0:
+            return "z"  # zero (and, clamped, negative) values
+        return str(math.ceil(math.log(value) / cls.log_gamma))
+
+    def add(self, value, count=1):
+        k = self.key(value)
+        self.bins[k] = self.bins.get(k, 0) + count
+
+    def merge(self, other):
+        for k, count in other.bins.items():
+            self.bins[k] = self.bins.get(k, 0) + count
+        return self
+
+    @property
+    def count(self):
+        return sum(self.bins.values())
+
+    def quantile(self, q):
+        total = self.count
+        if not total:
+            return None
+        rank = q * (total - 1)
+        seen = 0
+        for k in sorted(self.bins, key=lambda k: -math.inf if k == "z" else int(k)):
+            seen += self.bins[k]
+            if seen > rank:
+                if k == "z":
+                    return 0.0
+                return 2 * self.gamma ** int(k) / (self.gamma + 1)
+        return None
+
+
+class ValueCounts:
+    """
+    Exact counts per value for metrics with a handful of integer values (the
+    1-5 rating), where a log-binned sketch would report 2.97 for a 3. Same
+    interface as QuantileSketch; stored as {value: count} under "counts".
+    """
+
+    field = "counts"
+
+    def __init__(self, counts=None):
+        self.bins = {str(k): v for k, v in (counts or {}).items()}
+
+    @classmethod
+    def key(cls, value):
+        return str(int(round(value)))
+
+    def add(self, value, count=1):
+        k = self.key(value)
+        self.bins[k] = self.bins.get(k, 0) + count
+
+    def merge(self, other):
+        for k, count in other.bins.items():
+            self.bins[k] = self.bins.get(k, 0) + count
+        return self
+
+    @property
+    def count(self):
+        return sum(self.bins.values())
+
+    def quantile(self, q):
+        total = self.count
+        if not total:
+            return None
+        rank = q * (total - 1)
+        seen = 0
+        for k in sorted(self.bins, key=int):
+            seen += self.bins[k]
+            if seen > rank:
+                return float(k)
+        return None
+
+
+class HyperLogLog:
+    """Cardinality sketch; merging two sketches is the register-wise max."""
+
+    def __init__(self, registers=None, precision=HLL_PRECISION):
+        self.p = precision
+        self.m = 1 << precision
+        self.registers = {str(k): v for k, v in (registers or {}).items()}
+
+    def add(self, item):
+        h = int.from_bytes(hashlib.blake2b(str(item).encode(), digest_size=8).digest(), "big")
+        idx = h >> (64 - self.p)
+        rest = (h << self.p) & ((1 << 64) - 1)
+        rho = 64 - self.p + 1 if rest == 0 else (64 - rest.bit_length()) + 1
+        k = str(idx)
+        if rho > self.registers.get(k, 0):
+            self.registers[k] = rho
+
+    def merge(self, other):
+        for k, rho in other.registers.items():
+            if rho > self.registers.get(k, 0):
+                self.registers[k] = rho
+        return self
+
+    def cardinality(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        zeros = self.m - len(self.registers)
+        harmonic = zeros + sum(2.0 ** -rho for rho in self.registers.values())
+        estimate = alpha * self.m * self.m / harmonic
+        if estimate <= 2.5 * self.m and zeros:
+            estimate = self.m * math.log(self.m / zeros)  # linear counting for small sets
+        return int(round(estimate))
+
+
+def hash_token(value):
+    """Stable, non-reversible token for values (like reporter names) that go into the job log."""
+    return hashlib.blake2b(str(value).strip().lower().encode(), digest_size=8).hexdigest()
@@ -0,0 +1,180 @@
+# utils/stats_aggregator.py
+import asyncio, os
+from collections import Counter
+from datetime import datetime
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError
+import database
+from utils.stats_updater import stats_inc_op, stats_incs, delta_cell_key
+from utils.stats_timeseries import timeseries_inc_ops
+from utils.analytics_cube import CubeRollup
+from utils.stats_sketches import SketchRollup
+from utils.heatmap_grid import GridRollup
+from utils.tiles import TileRollup
+from utils.versions import versions
+from utils.stats_events import stats_events
+
+STATS_FLUSH_SECONDS = float(os.getenv("STATS_FLUSH_SECONDS", "5"))
+STATS_FLUSH_REPORTS = int(os.getenv("STATS_FLUSH_REPORTS", "500"))
+
+
+class StatsAggregator:
+    """
+    Write-behind buffer for stats. Processed reports add their delta here
+    instead of writing the global/district documents themselves; deltas are
+    summed per (district, service, sentiment, hour) cell and flushed every
+    STATS_FLUSH_SECONDS or STATS_FLUSH_REPORTS reports as one bulk_write of
+    $inc upserts to `stats`, followed by the derived collections
+    (`stats_timeseries` and one per rollup, e.g. the analytics cube, the
+    heatmap grid or the vector tile versions). The applied increments are
+    then published to the /analytics/stream clients. When a bulk_write fails
+    only its failed ops (per BulkWriteError writeErrors) are kept and retried
+    by the next flush, so no $inc is ever applied twice.
+
+    Durability comes from the job log: every completed job stores its delta
+    in `result.stats`, and jobs are marked `stats_applied` only once the
+    stats documents and every derived collection hold their delta (writes
+    parked for retry hold the marking back). After a crash, recover()
+    re-adds the deltas of done jobs that were never applied, to all
+    collections. A crash after some of those writes but before the jobs are
+    marked can count them twice; counts are never lost.
+    """
+
+    def __init__(self, rollups=(), flush_seconds=STATS_FLUSH_SECONDS, flush_reports=STATS_FLUSH_REPORTS):
+        self.flush_seconds = flush_seconds
+        self.flush_reports = max(1, flush_reports)
+        self.rollups = list(rollups)
+        self._cells = {}
+        self._job_ids = []
+        self._unapplied = []  # flushed jobs waiting for their retried writes
+        self._retry = {}  # writer name -> [(meta, op)] whose write failed
+        self._lock = asyncio.Lock()
+        self._task = None
+        self.flushes = 0
+        self.reports_flushed = 0
+
+    def add(self, job_id, delta):
+        key = delta_cell_key(delta)
+        cell = self._cells.setdefault(key, [0, 0])
+        cell[0] += 1
+        cell[1] += delta["rating"]
+        for rollup in self.rollups:
+            rollup.add(delta)
+        self._job_ids.append(job_id)
+        if len(self._job_ids) >= self.flush_reports and not self._lock.locked():
+            asyncio.create_task(self.flush())
+
+    async def _write(self, name, collection, entries):
+        """
+        Writes [(meta, op)] (plus this writer's ops left over from earlier
+        flushes) as one unordered bulk_write and returns the metas of the ops
+        that were applied. Only the failed ops are kept for the next flush:
+        the others already incremented their documents and must not again.
+        """
+        entries = self._retry.pop(name, []) + entries
+        if not entries:
+            return []
+        failed = set()
+        try:
+            await database.db[collection].bulk_write([op for _, op in entries], ordered=False)
+        except BulkWriteError as e:
+            failed = {err["index"] for err in e.details.get("writeErrors", [])}
+        except Exception as e:
+            failed = set(range(len(entries)))
+            print(f"❌ {collection} flush failed, will retry:", e)
+        if failed:
+            self._retry[name] = [entries[i] for i in sorted(failed)]
+            print(f"❌ {len(failed)} of {len(entries)} {collection} updates failed, will retry")
+        return [meta for i, (meta, _) in enumerate(entries) if i not in failed]
+
+    async def flush(self):
+        async with self._lock:
+            if not (self._job_ids or self._retry or self._unapplied) or database.db is None:
+                return
+            cells, job_ids = self._cells, self._job_ids
+            self._cells, self._job_ids = {}, []
+
+            now = datetime.utcnow()
+            written = await self._write("stats", "stats", [
+                ((doc_id, scope, district, inc), stats_inc_op(doc_id, scope, district, inc, now))
+                for doc_id, (scope, district, inc) in stats_incs(cells).items()
+            ])
+            # derived collections are written independently of the stats
+            # documents, each retrying only its own failed ops
+            derived = [("timeseries", "stats_timeseries", timeseries_inc_ops(cells))]
+            derived += [(type(r).__name__, r.collection, r.take_ops()) for r in self.rollups]
+            for name, collection, ops in derived:
+                await self._write(name, collection, [(None, op) for op in ops])
+
+            applied = {}
+            for doc_id, scope, district, inc in written:
+                applied.setdefault(doc_id, (scope, district, Counter()))[2].update(inc)
+            for doc_id in applied:
+                versions.bump(f"stats:{doc_id}")
+            versions.bump("stats:any")
+            stats_events.publish(applied)
+            if job_ids:
+                self.flushes += 1
+                self.reports_flushed += len(job_ids)
+                print(f"📊 Flushed stats for {len(job_ids)} reports ({len(cells)} cells)")
+
+            # a job is applied once every collection holds its delta; while
+            # any write is still parked for retry its jobs stay unmarked, so
+            # recover() replays them if the process dies first
+            self._unapplied.extend(job_ids)
+            if self._unapplied and not self._retry:
+                await database.db.jobs.update_many(
+                    {"_id": {"$in": self._unapplied}}, {"$set": {"stats_applied": True}},
+                )
+                self._unapplied = []
+
+    async def recover(self, db):
+        """Re-adds the deltas of completed jobs whose stats never reached the stats documents."""
+        await db.jobs.create_index([("state", ASCENDING), ("stats_applied", ASCENDING)])
+        # jobs from before the write-behind stats carry no delta; they were applied directly
+        await db.jobs.update_many(
+            {"state": "done", "stats_applied": None, "result.stats": {"$exists": False}},
+            {"$set": {"stats_applied": True}},
+        )
+        recovered = 0
+        async for job in db.jobs.find({"state": "done", "stats_applied": None}, {"result.stats": 1}):
+            self.add(job["_id"], job["result"]["stats"])
+            recovered += 1
+        if recovered:
+            print(f"📊 Recovered unflushed stats for {recovered} reports")
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            try:
+                await self.flush()
+            except Exception as e:
+                print("❌ Stats flush failed:", e)
+
+    def stats(self):
+        return {
+            "pending_reports": len(self._job_ids),
+            "unapplied_reports": len(self._unapplied),
+            "pending_cells": len(self._cells),
+            "pending_retries": {name: len(entries) for name, entries in self._retry.items()},
+            "flushes": self.flushes,
+            "reports_flushed": self.reports_flushed,
+        }
+
+
+stats_aggregator = StatsAggregator(rollups=[CubeRollup(), SketchRollup(), GridRollup(), TileRollup()])
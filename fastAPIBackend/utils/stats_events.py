@@ -0,0 +1,106 @@
+# utils/stats_events.py
+import asyncio, json, os
+from collections import Counter
+
+STREAM_HEARTBEAT_SECONDS = float(os.getenv("STREAM_HEARTBEAT_SECONDS", "15"))
+STREAM_MAX_CLIENTS = int(os.getenv("STREAM_MAX_CLIENTS", "5000"))
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+class Subscription:
+    """
+    One /analytics/stream client. It holds at most one pending delta per stats
+    document: while the client is still sending the previous event, newer
+    deltas are summed into the pending ones instead of queued, so a slow
+    client costs memory per document it watches, not per event it missed.
+    """
+
+    def __init__(self, districts=None, include_global=True):
+        self.districts = districts  # None = every district
+        self.include_global = include_global
+        self._pending = {}
+        self._seq = 0
+        self._ready = asyncio.Event()
+        self.coalesced = 0
+
+    def wants(self, scope, district):
+        if scope == "global":
+            return self.include_global
+        return self.districts is None or district in self.districts
+
+    def push(self, seq, incs):
+        touched = False
+        for doc_id, (scope, district, inc) in incs.items():
+            if not self.wants(scope, district):
+                continue
+            if doc_id in self._pending:
+                self._pending[doc_id]["inc"].update(inc)
+                self.coalesced += 1
+            else:
+                self._pending[doc_id] = {"scope": scope, "district": district, "inc": Counter(inc)}
+            touched = True
+        if touched:
+            self._seq = seq
+            self._ready.set()
+
+    async def next(self, timeout):
+        """The coalesced (seq, deltas) since the last call, or None after `timeout` seconds without any."""
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        self._ready.clear()
+        pending, self._pending = self._pending, {}
+        return self._seq, {doc_id: {**p, "inc": dict(p["inc"])} for doc_id, p in pending.items()}
+
+
+class StatsEventBus:
+    """
+    In-process fan-out of stats deltas. The stats writers publish the
+    {doc_id: (scope, district, increments)} they just applied (see
+    stats_updater.stats_incs) and every subscription receives them from
+    memory, so connected clients add no Mongo reads.
+    """
+
+    def __init__(self, max_subscribers=STREAM_MAX_CLIENTS):
+        self.max_subscribers = max_subscribers
+        self._subscribers = set()
+        self.seq = 0
+
+    def subscribe(self, districts=None, include_global=True):
+        if len(self._subscribers) >= self.max_subscribers:
+            raise TooManySubscribers(f"Stream limit of {self.max_subscribers} clients reached")
+        sub = Subscription(districts, include_global)
+        self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        self._subscribers.discard(sub)
+
+    def publish(self, incs):
+        if not incs:
+            return
+        self.seq += 1
+        for sub in self._subscribers:
+            sub.push(self.seq, incs)
+
+    def stats(self):
+        return {
+            "subscribers": len(self._subscribers),
+            "events_published": self.seq,
+            "coalesced": sum(s.coalesced for s in self._subscribers),
+        }
+
+
+def sse_event(event, data, event_id=None):
+    lines = [f"event: {event}"]
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {json.dumps(data, separators=(',', ':'))}")
+    return "\n".join(lines) + "\n\n"
+
+
+stats_events = StatsEventBus()
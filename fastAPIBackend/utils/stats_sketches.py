@@ -0,0 +1,132 @@
+# utils/stats_sketches.py
+import asyncio
+from pymongo import UpdateOne
+from utils.geo import parse_device_location
+from utils.versions import versions
+from utils.sketches import QuantileSketch, ValueCounts, HyperLogLog, hash_token
+
+# Distribution sketches kept per district in `sketches` on the district stats
+# documents. Global figures are produced by merging the district sketches.
+# The 1-5 rating is counted exactly per value, the open-ended metrics are sketched.
+QUANTILE_METRICS = {"rating": ValueCounts, "priority_raw_score": QuantileSketch, "latency_seconds": QuantileSketch}
+DISTINCT_METRICS = ["reporters", "locations"]
+PERCENTILES = {"p50": 0.5, "p90": 0.9}
+
+
+def sketch_values(report, model_output, processed_at):
+    """What one report contributes to its district's sketches, as stored in the job result."""
+    quantiles = {
+        "rating": report.get("rating"),
+        "priority_raw_score": model_output.get("priority_raw_score"),
+        # the report _id is an ObjectId minted on insert, so it dates the submission
+        "latency_seconds": (processed_at - report["_id"].generation_time.replace(tzinfo=None)).total_seconds(),
+    }
+    distinct = {}
+    if report.get("name"):
+        distinct["reporters"] = hash_token(report["name"])
+    location = parse_device_location(report.get("device_location"))
+    if location:
+        distinct["locations"] = hash_token(f"{location[0]:.4f},{location[1]:.4f}")  # ~11 m cells
+    return {
+        "quantiles": {k: v for k, v in quantiles.items() if v is not None},
+        "distinct": distinct,
+    }
+
+
+class SketchRollup:
+    """Stats aggregator rollup: collects per-district sketch updates between flushes."""
+
+    collection = "stats"
+
+    def __init__(self):
+        self._districts = {}
+
+    def add(self, delta):
+        values = delta.get("sketch")
+        if not values:
+            return
+        quantiles, distinct = self._districts.setdefault(
+            delta["district"],
+            ({m: cls() for m, cls in QUANTILE_METRICS.items()}, {m: HyperLogLog() for m in DISTINCT_METRICS}),
+        )
+        for metric, value in values.get("quantiles", {}).items():
+            if metric in quantiles:
+                quantiles[metric].add(value)
+        for metric, token in values.get("distinct", {}).items():
+            if metric in distinct:
+                distinct[metric].add(token)
+
+    def take_ops(self):
+        districts, self._districts = self._districts, {}
+        ops = []
+        for district, (quantiles, distinct) in districts.items():
+            inc = {
+                f"sketches.{metric}.{sketch.field}.{k}": count
+                for metric, sketch in quantiles.items() for k, count in sketch.bins.items()
+            }
+            maxes = {
+                f"sketches.{metric}.hll.{k}": rho
+                for metric, hll in distinct.items() for k, rho in hll.registers.items()
+            }
+            update = {"$inc": inc}
+            if maxes:
+                update["$max"] = maxes
+            ops.append(UpdateOne({"_id": f"district_{district}"}, update, upsert=True))
+        return ops
+
+
+def _rounded(value):
+    return round(value, 2) if value is not None else None
+
+
+def summarize_sketches(sketch_docs):
+    """
+    Merges the `sketches` subdocuments of one or more stats documents and
+    returns ({metric: {p50, p90}}, {metric: distinct count}).
+    """
+    quantiles = {m: cls() for m, cls in QUANTILE_METRICS.items()}
+    distinct = {m: HyperLogLog() for m in DISTINCT_METRICS}
+    for doc in sketch_docs:
+        for metric, cls in QUANTILE_METRICS.items():
+            quantiles[metric].merge(cls((doc.get(metric) or {}).get(cls.field)))
+        for metric in DISTINCT_METRICS:
+            distinct[metric].merge(HyperLogLog((doc.get(metric) or {}).get("hll")))
+
+    percentiles = {
+        metric: {name: _rounded(sketch.quantile(q)) for name, q in PERCENTILES.items()}
+        for metric, sketch in quantiles.items()
+    }
+    distinct_counts = {metric: hll.cardinality() for metric, hll in distinct.items()}
+    return percentiles, distinct_counts
+
+
+# (etag of "stats:any", task computing the global summary)
+_global_summary = (None, None)
+
+
+async def global_sketch_summary(db):
+    """
+    summarize_sketches over the sketches of every district, which is what the
+    global document reports. The merge is pure Python, so it runs in a thread,
+    and one result is shared by all requests until the stats change: it is
+    keyed on the "stats:any" ETag, which also rolls over with the ETag epoch
+    to pick up writes from other processes.
+    """
+    global _global_summary
+    key = versions.etag(["stats:any"])
+    cached_key, task = _global_summary
+    if cached_key != key:
+        task = asyncio.create_task(_load_global_summary(db))
+        _global_summary = (key, task)
+    try:
+        return await asyncio.shield(task)
+    except Exception:
+        if _global_summary[1] is task:
+            _global_summary = (None, None)  # don't keep serving the failure
+        raise
+
+
+async def _load_global_summary(db):
+    cursor = db.stats.find({"scope": "district", "sketches": {"$exists": True}}, {"sketches": 1})
+    sketch_docs = [d["sketches"] async for d in cursor]
+    return await asyncio.to_thread(summarize_sketches, sketch_docs)
@@ -0,0 +1,122 @@
+# utils/stats_timeseries.py
+import os
+from collections import Counter
+from datetime import datetime, timedelta
+from pymongo import UpdateOne, ASCENDING
+from utils.stats_updater import stats_doc_ids, field_key
+
+# Feedback over time lives in its own collection, one small document per
+# (granularity, scope, district, service, bucket). Every flush increments
+# the hour, day and month bucket together, so rollups are always current
+# and /analytics reads only the buckets of the granularity it needs.
+GRANULARITIES = ("hour", "day", "month")
+BUCKET_FORMATS = {"hour": "%Y-%m-%dT%H:00", "day": "%Y-%m-%d", "month": "%Y-%m"}
+# Days to keep each granularity for; 0 keeps it forever.
+RETENTION_DAYS = {
+    "hour": int(os.getenv("STATS_RETENTION_HOURLY_DAYS", "14")),
+    "day": int(os.getenv("STATS_RETENTION_DAILY_DAYS", "730")),
+    "month": int(os.getenv("STATS_RETENTION_MONTHLY_DAYS", "0")),
+}
+HOUR_FORMAT = "%Y-%m-%dT%H"
+
+
+def bucket_start(when, granularity):
+    if granularity == "hour":
+        return when.replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        return when.replace(hour=0, minute=0, second=0, microsecond=0)
+    return when.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def bucket_label(bucket, granularity):
+    return bucket.strftime(BUCKET_FORMATS[granularity])
+
+
+def parse_hour(hour):
+    """Stats deltas carry their hour as 'YYYY-MM-DDTHH' (older ones only a 'YYYY-MM-DD' day)."""
+    if "T" in hour:
+        return datetime.strptime(hour, HOUR_FORMAT)
+    return datetime.strptime(hour, "%Y-%m-%d")
+
+
+async def ensure_timeseries_indexes(db):
+    await db.stats_timeseries.create_index(
+        [("granularity", ASCENDING), ("scope", ASCENDING), ("district", ASCENDING), ("bucket", ASCENDING)]
+    )
+    await db.stats_timeseries.create_index("expires_at", expireAfterSeconds=0)
+
+
+def timeseries_inc_ops(cells):
+    """
+    Turns aggregated cells {(district, service, sentiment, hour): [count, rating_sum]}
+    into $inc upserts on the hour, day and month buckets of the global and
+    district scopes.
+    """
+    buckets = {}
+    for (district, service, s, hour), (count, rating_sum) in cells.items():
+        when = parse_hour(hour)
+        for granularity in GRANULARITIES:
+            start = bucket_start(when, granularity)
+            for _, scope, doc_district in stats_doc_ids(district):
+                key = (granularity, scope, doc_district, service, start)
+                inc = buckets.setdefault(key, Counter())
+                inc["count"] += count
+                inc["rating_sum"] += rating_sum
+                inc[f"sentiment.{field_key(s)}"] += count
+
+    ops = []
+    for (granularity, scope, district, service, start), inc in buckets.items():
+        static = {"granularity": granularity, "scope": scope, "district": district,
+                  "service": service, "bucket": start}
+        if RETENTION_DAYS[granularity]:
+            static["expires_at"] = start + timedelta(days=RETENTION_DAYS[granularity])
+        doc_id = f"{granularity}|{scope}|{district or ''}|{service}|{bucket_label(start, granularity)}"
+        ops.append(UpdateOne({"_id": doc_id}, {"$inc": dict(inc), "$setOnInsert": static}, upsert=True))
+    return ops
+
+
+async def read_timeline(db, scope, district, granularity="day", start=None, end=None):
+    """Feedback counts per bucket label in [start, end), summed over services."""
+    match = {"granularity": granularity, "scope": scope, "district": district if scope == "district" else None}
+    if start or end:
+        match["bucket"] = {}
+        if start:
+            match["bucket"]["$gte"] = bucket_start(start, granularity)
+        if end:
+            match["bucket"]["$lt"] = end
+    pipeline = [
+        {"$match": match},
+        {"$group": {"_id": "$bucket", "count": {"$sum": "$count"}}},
+        {"$sort": {"_id": 1}},
+    ]
+    return {bucket_label(row["_id"], granularity): row["count"] async for row in db.stats_timeseries.aggregate(pipeline)}
+
+
+async def migrate_legacy_timeline(db):
+    """
+    Moves the old per-document `feedback_over_time` day counts into daily and
+    monthly buckets. Those counts had no service, rating or sentiment
+    breakdown, so they land under the service '_legacy' with counts only.
+    """
+    migrated = 0
+    async for stats in db.stats.find({"feedback_over_time": {"$exists": True}}):
+        ops = []
+        for day, count in (stats.get("feedback_over_time") or {}).items():
+            try:
+                when = datetime.strptime(day, "%Y-%m-%d")
+            except ValueError:
+                continue
+            for granularity in ("day", "month"):
+                start = bucket_start(when, granularity)
+                static = {"granularity": granularity, "scope": stats.get("scope", "global"),
+                          "district": stats.get("district"), "service": "_legacy", "bucket": start}
+                if RETENTION_DAYS[granularity]:
+                    static["expires_at"] = start + timedelta(days=RETENTION_DAYS[granularity])
+                doc_id = f"{granularity}|{static['scope']}|{static['district'] or ''}|_legacy|{bucket_label(start, granularity)}"
+                ops.append(UpdateOne({"_id": doc_id}, {"$inc": {"count": count}, "$setOnInsert": static}, upsert=True))
+        if ops:
+            await db.stats_timeseries.bulk_write(ops, ordered=False)
+        await db.stats.update_one({"_id": stats["_id"]}, {"$unset": {"feedback_over_time": ""}})
+        migrated += 1
+    if migrated:
+        print(f"📊 Moved feedback_over_time of {migrated} stats documents to stats_timeseries")
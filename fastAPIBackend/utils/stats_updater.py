@@ -1,74 +1,134 @@
 # utils/stats_updater.py
+from collections import Counter
 from datetime import datetime
-import database
-from math import isclose
+from pymongo import UpdateOne
+from utils.stats_sketches import summarize_sketches
 
+SENTIMENTS = ("positive", "neutral", "negative")
 
-async def update_global_stats(model_output, service, rating, district):
-    db = database.db
-    if db is None:
-        print("❌ Database not initialized in update_global_stats")
-        return
 
-    # 1️⃣ Update GLOBAL stats
-    await _update_stats_document(db, "global_stats", "global", None, model_output, service, rating)
+def field_key(name):
+    """Service / sentiment names become field path segments, so '.' and a leading '$' are not allowed."""
+    return str(name).replace(".", "_").lstrip("$") or "_"
 
-    # 2️⃣ Update DISTRICT stats
-    district_key = f"district_{district}"
-    await _update_stats_document(db, district_key, "district", district, model_output, service, rating)
 
+def stats_doc_ids(district):
+    return [("global_stats", "global", None), (f"district_{district}", "district", district)]
 
-async def _update_stats_document(db, doc_id, scope, district, model_output, service, rating):
-    stats = await db.stats.find_one({"_id": doc_id}) or {}
 
-    # Extract existing stats
-    avg_rating_overall = stats.get("avg_rating_overall", 0)
-    total_feedback = stats.get("total_feedback_overall", 0)
-    ratings_by_service = stats.get("avg_rating_by_service", {})
-    s_counts_overall = stats.get("sentiment_counts_overall", {"positive": 0, "neutral": 0, "negative": 0})
-    s_counts_by_service = stats.get("sentiment_counts_by_service", {})
-    total_feedback_by_service = stats.get("total_feedback_by_service", {})
-    timeline = stats.get("feedback_over_time", {})
+def stats_delta(model_output, service, rating, district, when=None):
+    """What one processed report adds to the stats, as stored in its job's result."""
+    return {
+        "district": district,
+        "service": service,
+        "sentiment": model_output.get("sentiment", "neutral"),
+        "hour": (when or datetime.utcnow()).strftime("%Y-%m-%dT%H"),
+        "rating": rating,
+    }
 
-    # --- Update averages ---
-    new_total = total_feedback + 1
-    avg_rating_overall = round(((avg_rating_overall * total_feedback) + rating) / new_total, 2)
 
-    # per service average
-    prev_rating = ratings_by_service.get(service, rating)
-    ratings_by_service[service] = round((prev_rating + rating) / 2, 2)
+def delta_cell_key(delta):
+    # deltas recorded before hourly buckets only carry a day
+    return (delta["district"], delta["service"], delta["sentiment"], delta.get("hour") or delta["day"])
 
-    # --- Update sentiment counts ---
-    s = model_output.get("sentiment", "neutral")
-    if s not in s_counts_overall:
-        s_counts_overall[s] = 0
-    s_counts_overall[s] += 1
 
-    s_counts_by_service.setdefault(service, {"positive": 0, "neutral": 0, "negative": 0})
-    s_counts_by_service[service][s] += 1
+def stats_incs(cells):
+    """
+    Turns aggregated cells {(district, service, sentiment, hour): [count, rating_sum]}
+    into {doc_id: (scope, district, {field path: increment})} for the global
+    document and every district touched.
+    """
+    incs = {}
+    for (district, service, s, _), (count, rating_sum) in cells.items():
+        svc, sent = field_key(service), field_key(s)
+        for doc_id, scope, doc_district in stats_doc_ids(district):
+            _, _, inc = incs.setdefault(doc_id, (scope, doc_district, Counter()))
+            inc["total_feedback_overall"] += count
+            inc["rating_sum_overall"] += rating_sum
+            inc[f"total_feedback_by_service.{svc}"] += count
+            inc[f"rating_sum_by_service.{svc}"] += rating_sum
+            inc[f"sentiment_counts_overall.{sent}"] += count
+            inc[f"sentiment_counts_by_service.{svc}.{sent}"] += count
+    return incs
 
-    # --- Update feedback totals ---
-    total_feedback_by_service[service] = total_feedback_by_service.get(service, 0) + 1
 
-    # --- Timeline ---
-    today = datetime.utcnow().strftime("%Y-%m-%d")
-    timeline[today] = timeline.get(today, 0) + 1
-
-    await db.stats.update_one(
+def stats_inc_op(doc_id, scope, district, inc, now=None):
+    return UpdateOne(
         {"_id": doc_id},
-        {"$set": {
-            "scope": scope,
-            "district": district,
-            "avg_rating_overall": avg_rating_overall,
-            "avg_rating_by_service": ratings_by_service,
-            "sentiment_counts_overall": s_counts_overall,
-            "sentiment_counts_by_service": s_counts_by_service,
-            "total_feedback_overall": new_total,
-            "total_feedback_by_service": total_feedback_by_service,
-            "feedback_over_time": timeline,
-            "last_updated": datetime.utcnow()
-        }},
-        upsert=True
+        {"$inc": dict(inc), "$set": {"scope": scope, "district": district, "last_updated": now or datetime.utcnow()}},
+        upsert=True,
     )
 
-    print(f"📊 Updated stats for {scope.upper()} ({district or 'ALL'})")
+
+def stats_inc_ops(cells):
+    """
+    One upsert per stats document. Reports only add to sums and counts with
+    $inc, so concurrent workers never lose updates and nothing has to be
+    read first. Averages are derived on read; counts over time live in
+    stats_timeseries.
+    """
+    now = datetime.utcnow()
+    return [
+        stats_inc_op(doc_id, scope, doc_district, inc, now)
+        for doc_id, (scope, doc_district, inc) in stats_incs(cells).items()
+    ]
+
+
+def with_derived_averages(stats, summary=None):
+    """
+    Fills the average fields of a stats document from its sums and counts,
+    and its percentiles / distinct counts from `summary`, a summarize_sketches
+    result (defaults to summarizing the document's own sketches).
+    """
+    stats = dict(stats)
+    if summary is None:
+        summary = summarize_sketches([stats.get("sketches") or {}])
+    stats["percentiles"], stats["distinct_counts"] = summary
+    total = stats.get("total_feedback_overall", 0)
+    totals_by_service = stats.get("total_feedback_by_service", {})
+    sums_by_service = stats.get("rating_sum_by_service", {})
+
+    stats["avg_rating_overall"] = round(stats.get("rating_sum_overall", 0) / total, 2) if total else 0.0
+    stats["avg_rating_by_service"] = {
+        svc: round(sums_by_service.get(svc, 0) / count, 2)
+        for svc, count in totals_by_service.items() if count
+    }
+    for counts in [stats.get("sentiment_counts_overall", {})] + list(stats.get("sentiment_counts_by_service", {}).values()):
+        for s in SENTIMENTS:
+            counts.setdefault(s, 0)
+    return stats
+
+
+def negative_share(stats):
+    counts = stats.get("sentiment_counts_overall", {})
+    total = sum(counts.values())
+    return round(counts.get("negative", 0) / total, 4) if total else 0.0
+
+
+async def migrate_stats_schema(db):
+    """
+    Converts stats documents written by the old read-modify-write updater
+    (stored averages, no sums) to the sum/count schema. Per-service sums are
+    rebuilt from the old per-service "average", which was not a true mean;
+    run utils/rebuild_stats for exact numbers.
+    """
+    migrated = 0
+    async for stats in db.stats.find({"rating_sum_overall": {"$exists": False}}):
+        total = stats.get("total_feedback_overall", 0)
+        totals_by_service = stats.get("total_feedback_by_service", {})
+        avgs_by_service = stats.get("avg_rating_by_service", {})
+        await db.stats.update_one(
+            {"_id": stats["_id"], "rating_sum_overall": {"$exists": False}},
+            {
+                "$set": {
+                    "rating_sum_overall": stats.get("avg_rating_overall", 0) * total,
+                    "rating_sum_by_service": {
+                        svc: avgs_by_service.get(svc, 0) * count for svc, count in totals_by_service.items()
+                    },
+                },
+                "$unset": {"avg_rating_overall": "", "avg_rating_by_service": ""},
+            },
+        )
+        migrated += 1
+    if migrated:
+        print(f"📊 Migrated {migrated} stats documents to sum/count schema")
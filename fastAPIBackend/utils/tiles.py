@@ -0,0 +1,255 @@
+# utils/tiles.py
+"""
+Vector tiles of processed report locations, served as /tiles/{z}/{x}/{y}.mvt.
+
+Every tile has a data version in `tile_versions`, bumped by the stats
+aggregator (TileRollup) for every tile whose content a newly processed
+report can change. Built tiles are cached on disk under
+TILE_CACHE_DIR/z/x/y-<version>.mvt, so a tile is rebuilt only after such a
+report was processed; every other cached tile stays valid.
+"""
+import asyncio, glob, math, os, uuid
+from collections import Counter
+
+from pymongo import UpdateOne
+
+from pipeline.executor import heatmap_executor
+from utils import geohash
+from utils.geo import within_bbox
+from utils.heatmap_grid import read_grid_cells, grid_precision
+from utils.mvt import encode_tile, MVT_EXTENT
+
+TILE_CACHE_DIR = os.getenv("TILE_CACHE_DIR", "tile_cache")
+TILE_MAX_ZOOM = int(os.getenv("TILE_MAX_ZOOM", "18"))
+TILE_GRID_MAX_ZOOM = 12  # up to here tiles are built from the heatmap grid, above from the reports
+TILE_BIN = 16  # points closer than this many tile units (of 4096) are merged into one feature
+TILE_BUFFER = 64
+TILE_LAYER = "reports"
+
+
+def _mercator(lat, lon, z):
+    """Fractional web-mercator tile coordinates of a point at zoom z."""
+    n = 2 ** z
+    lat = max(-85.05112878, min(85.05112878, lat))
+    return (lon + 180) / 360 * n, (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n
+
+
+def tile_for(lat, lon, z):
+    n = 2 ** z
+    x, y = _mercator(lat, lon, z)
+    return min(n - 1, max(0, int(x))), min(n - 1, max(0, int(y)))
+
+
+def tiles_near(west, south, east, north, z):
+    """
+    Every tile at zoom z whose area plus TILE_BUFFER overlaps the box, i.e.
+    every tile that may draw a point lying in it.
+    """
+    n = 2 ** z
+    pad = TILE_BUFFER / MVT_EXTENT
+    x0, y0 = _mercator(north, west, z)
+    x1, y1 = _mercator(south, east, z)
+    xs = range(max(0, math.ceil(x0 - pad) - 1), min(n - 1, math.floor(x1 + pad)) + 1)
+    ys = range(max(0, math.ceil(y0 - pad) - 1), min(n - 1, math.floor(y1 + pad)) + 1)
+    return [(x, y) for x in xs for y in ys]
+
+
+def tile_bounds(z, x, y):
+    """(west, south, east, north) of a web-mercator tile."""
+    n = 2 ** z
+
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y)
+
+
+def _to_tile(lat, lon, z, x, y):
+    fx, fy = _mercator(lat, lon, z)
+    return (fx - x) * MVT_EXTENT, (fy - y) * MVT_EXTENT
+
+
+class TileRollup:
+    """
+    Stats aggregator rollup that bumps the version of every tile a newly
+    processed report can change. Up to TILE_GRID_MAX_ZOOM tiles draw grid
+    cell centroids, which move anywhere inside the cell as reports land, so
+    every tile near the report's whole cell is bumped; above it tiles draw
+    the reports themselves and only the tiles near the point are.
+    """
+
+    collection = "tile_versions"
+
+    def __init__(self):
+        self._touched = Counter()
+
+    def add(self, delta):
+        location = delta.get("location")
+        if not location:
+            return
+        lat, lon = location
+        for z in range(TILE_MAX_ZOOM + 1):
+            if z <= TILE_GRID_MAX_ZOOM:
+                # the precision _grid_points reads for the tile holding the report
+                precision = grid_precision(tile_bounds(z, *tile_for(lat, lon, z)), z)
+                south, west, north, east = geohash.bounds(geohash.encode(lat, lon, precision))
+            else:
+                south, west, north, east = lat, lon, lat, lon
+            for tx, ty in tiles_near(west, south, east, north, z):
+                self._touched[f"{z}/{tx}/{ty}"] += 1
+
+    def take_ops(self):
+        touched, self._touched = self._touched, Counter()
+        return [UpdateOne({"_id": key}, {"$inc": {"v": n}}, upsert=True) for key, n in touched.items()]
+
+
+async def tile_version(db, z, x, y):
+    doc = await db.tile_versions.find_one({"_id": f"{z}/{x}/{y}"}, {"v": 1})
+    return doc["v"] if doc else 0
+
+
+def _grid_points(cells):
+    """(lat, lon, count, rating_sum, services) per heatmap grid cell."""
+    merged = {}
+    for cell in cells:
+        m = merged.setdefault(cell["cell"], [0, 0.0, 0.0, 0, Counter()])
+        m[0] += cell["count"]
+        m[1] += cell["lat_sum"]
+        m[2] += cell["lon_sum"]
+        m[3] += cell["rating_sum"]
+        m[4][cell["public_service"]] += cell["count"]
+    return [(lat_sum / n, lon_sum / n, n, rating_sum, services)
+            for n, lat_sum, lon_sum, rating_sum, services in merged.values() if n]
+
+
+async def _tile_reports(db, bounds, z, x, y):
+    """
+    The tile's processed reports grouped in Mongo into the TILE_BIN bins
+    encode_points would put them in, so a dense tile returns one row per
+    occupied bin (with its per-service counts) rather than every report.
+    """
+    n = 2 ** z
+    lon = {"$arrayElemAt": ["$location.coordinates", 0]}
+    lat = {"$degreesToRadians": {"$max": [-85.05112878, {"$min": [85.05112878, {
+        "$arrayElemAt": ["$location.coordinates", 1]}]}]}}
+    # _to_tile in tile units, divided by the bin size
+    fx = {"$multiply": [{"$add": [lon, 180]}, n / 360]}
+    fy = {"$multiply": [{"$subtract": [1, {"$divide": [{"$asinh": {"$tan": lat}}, math.pi]}]}, n / 2]}
+    scale = MVT_EXTENT / TILE_BIN
+    bin_id = {
+        "bx": {"$floor": {"$multiply": [{"$subtract": [fx, x]}, scale]}},
+        "by": {"$floor": {"$multiply": [{"$subtract": [fy, y]}, scale]}},
+    }
+    pipeline = [
+        {"$match": {"processing": 2, **within_bbox(bounds)}},
+        {"$group": {
+            "_id": {**bin_id, "service": "$public_service"},
+            "count": {"$sum": 1},
+            "lat_sum": {"$sum": {"$arrayElemAt": ["$location.coordinates", 1]}},
+            "lon_sum": {"$sum": lon},
+            "rating_sum": {"$sum": {"$ifNull": ["$rating", 0]}},
+        }},
+        {"$group": {
+            "_id": {"bx": "$_id.bx", "by": "$_id.by"},
+            "count": {"$sum": "$count"},
+            "lat_sum": {"$sum": "$lat_sum"},
+            "lon_sum": {"$sum": "$lon_sum"},
+            "rating_sum": {"$sum": "$rating_sum"},
+            "services": {"$push": {"service": "$_id.service", "count": "$count"}},
+        }},
+    ]
+    return await db.reports.aggregate(pipeline, allowDiskUse=True).to_list(length=None)
+
+
+def _report_points(rows):
+    """(lat, lon, count, rating_sum, services) per bin of reports, at the bin's centroid."""
+    return [
+        (row["lat_sum"] / row["count"], row["lon_sum"] / row["count"], row["count"], row["rating_sum"],
+         Counter({s["service"]: s["count"] for s in row["services"]}))
+        for row in rows if row["count"]
+    ]
+
+
+async def build_tile(db, z, x, y):
+    """
+    Reads the tile's grid cells (up to TILE_GRID_MAX_ZOOM) or reports and
+    encodes them on the heatmap executor, see encode_points.
+    """
+    bounds = tile_bounds(z, x, y)
+    if z <= TILE_GRID_MAX_ZOOM:
+        to_points, rows = _grid_points, await read_grid_cells(db, bounds, z)
+    else:
+        to_points, rows = _report_points, await _tile_reports(db, bounds, z, x, y)
+    return await heatmap_executor.run(_encode_rows, to_points, rows, z, x, y)
+
+
+def _encode_rows(to_points, rows, z, x, y):
+    return encode_points(to_points(rows), z, x, y)
+
+
+def encode_points(points, z, x, y):
+    """
+    Encodes (lat, lon, count, rating_sum, services) points, thinned by
+    merging every point that falls in the same TILE_BIN x TILE_BIN bin into
+    one feature (count, avg_rating, top public_service at the bin's weighted centre).
+    """
+    bins = {}
+    for lat, lon, count, rating_sum, services in points:
+        px, py = _to_tile(lat, lon, z, x, y)
+        if not (-TILE_BUFFER <= px <= MVT_EXTENT + TILE_BUFFER and -TILE_BUFFER <= py <= MVT_EXTENT + TILE_BUFFER):
+            continue
+        b = bins.setdefault((int(px // TILE_BIN), int(py // TILE_BIN)), [0, 0.0, 0.0, 0, Counter()])
+        b[0] += count
+        b[1] += px * count
+        b[2] += py * count
+        b[3] += rating_sum
+        b[4].update(services)
+
+    features = [
+        (px_sum / n, py_sum / n, {
+            "count": n,
+            "avg_rating": round(rating_sum / n, 2),
+            "public_service": services.most_common(1)[0][0],
+        })
+        for n, px_sum, py_sum, rating_sum, services in bins.values()
+    ]
+    return encode_tile({TILE_LAYER: features}) if features else b""
+
+
+async def cached_tile(db, z, x, y, version):
+    """
+    The bytes of the tile at `version` (see tile_version) from the disk
+    cache, building and storing it on a miss. File IO runs in a thread,
+    never on the event loop.
+    """
+    data = await asyncio.to_thread(_read_cached, z, x, y, version)
+    if data is None:
+        data = await build_tile(db, z, x, y)
+        await asyncio.to_thread(_store_cached, z, x, y, version, data)
+    return data
+
+
+def _read_cached(z, x, y, version):
+    try:
+        with open(os.path.join(TILE_CACHE_DIR, str(z), str(x), f"{y}-{version}.mvt"), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _store_cached(z, x, y, version, data):
+    folder = os.path.join(TILE_CACHE_DIR, str(z), str(x))
+    path = os.path.join(folder, f"{y}-{version}.mvt")
+    os.makedirs(folder, exist_ok=True)
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)  # readers never see a half-written tile
+    # older versions of this tile can go; a newer one may just have been written by another request
+    for other in glob.glob(os.path.join(folder, f"{y}-*.mvt")):
+        other_version = os.path.basename(other)[len(f"{y}-"):-len(".mvt")]
+        if other_version.isdigit() and int(other_version) < version:
+            try:
+                os.remove(other)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,56 @@
+# utils/uploads.py
+import asyncio, hashlib, os, re, uuid
+
+UPLOAD_DIR = "storage"
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(256 * 1024)))
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+def _extension(filename):
+    ext = os.path.splitext(filename or "")[1].lower()
+    return ext if re.fullmatch(r"\.[a-z0-9]{1,8}", ext) else ""
+
+
+async def save_upload(upload_file, upload_dir=UPLOAD_DIR, max_bytes=MAX_UPLOAD_BYTES):
+    """
+    Streams an UploadFile to disk in chunks, hashing it on the fly.
+    File writes run in a worker thread so the event loop never blocks on
+    disk. The file is stored as `<sha256><ext>`, so identical images are
+    kept once and every report pointing at them shares the same imgUrl.
+    Raises UploadTooLarge as soon as more than max_bytes have been read.
+    """
+    size = getattr(upload_file, "size", None)
+    if size is not None and size > max_bytes:
+        raise UploadTooLarge(f"Image exceeds {max_bytes} bytes")
+
+    hasher = hashlib.sha256()
+    tmp_path = os.path.join(upload_dir, f".{uuid.uuid4().hex}.part")
+    f = await asyncio.to_thread(open, tmp_path, "wb")
+    try:
+        written = 0
+        while True:
+            chunk = await upload_file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            written += len(chunk)
+            if written > max_bytes:
+                raise UploadTooLarge(f"Image exceeds {max_bytes} bytes")
+            hasher.update(chunk)
+            await asyncio.to_thread(f.write, chunk)
+    except BaseException:
+        await asyncio.to_thread(f.close)
+        await asyncio.to_thread(os.remove, tmp_path)
+        raise
+    await asyncio.to_thread(f.close)
+
+    name = f"{hasher.hexdigest()}{_extension(upload_file.filename)}"
+    final_path = os.path.join(upload_dir, name)
+    if os.path.exists(final_path):
+        await asyncio.to_thread(os.remove, tmp_path)  # already stored, reuse it
+    else:
+        await asyncio.to_thread(os.replace, tmp_path, final_path)
+    return f"/storage/{name}"
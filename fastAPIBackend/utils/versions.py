@@ -0,0 +1,80 @@
+# utils/versions.py
+import hashlib, os, time, uuid
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import Response
+
+# ETags are built from an in-memory version counter per resource, bumped by
+# this process whenever it writes that resource. Writes made elsewhere (other
+# API processes, utils/rebuild_stats) are not seen, so every ETag also
+# carries the current ETAG_MAX_AGE_SECONDS epoch: they are picked up within
+# that window at the latest.
+ETAG_MAX_AGE_SECONDS = int(os.getenv("ETAG_MAX_AGE_SECONDS", "30"))
+BOOT_ID = uuid.uuid4().hex[:8]
+BOOT_TIME = datetime.now(timezone.utc).replace(microsecond=0)
+
+
+class VersionMap:
+    def __init__(self):
+        self._versions = {}
+        self._modified = {}
+
+    def bump(self, key):
+        self._versions[key] = self._versions.get(key, 0) + 1
+        self._modified[key] = datetime.now(timezone.utc).replace(microsecond=0)
+
+    def etag(self, keys, params=None):
+        state = "|".join(f"{k}={self._versions.get(k, 0)}" for k in keys)
+        state += f"|{sorted((params or {}).items())}"
+        digest = hashlib.sha1(state.encode()).hexdigest()[:16]
+        epoch = int(time.time() // ETAG_MAX_AGE_SECONDS)
+        return f'"{BOOT_ID}-{epoch}-{digest}"'
+
+    def last_modified(self, keys):
+        # never older than the current epoch, for the same reason as the ETag
+        epoch_start = datetime.fromtimestamp(time.time() // ETAG_MAX_AGE_SECONDS * ETAG_MAX_AGE_SECONDS, timezone.utc)
+        return max([self._modified.get(k, BOOT_TIME) for k in keys] + [epoch_start])
+
+
+def _etag_matches(header, etag):
+    if header.strip() == "*":
+        return True
+    candidates = [t.strip() for t in header.split(",")]
+    return etag in candidates or f"W/{etag}" in candidates
+
+
+def conditional_response(request, response, keys, params=None):
+    """
+    Sets ETag / Last-Modified on `response` and returns a 304 Response when
+    the client's If-None-Match (or, without one, If-Modified-Since) shows it
+    already has this version. Returns None when the body must be built.
+    """
+    etag = versions.etag(keys, params)
+    last_modified = versions.last_modified(keys)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(last_modified, usegmt=True),
+        "Cache-Control": "no-cache",
+    }
+    response.headers.update(headers)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+        return None
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return None
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        if last_modified <= since:
+            return Response(status_code=304, headers=headers)
+    return None
+
+
+versions = VersionMap()